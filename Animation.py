@@ -0,0 +1,181 @@
+################
+# Animation.py #
+################
+# Renders a numbered sequence of frames while the
+# camera moves along a path, all in one process. The
+# scene is built once, worker processes start once and
+# keep their copy of it, and every frame is saved in
+# the background while the next one is traced.
+#
+# The path is a JSON file of keyframes, each giving
+# the camera's position, direction, up and fov at some
+# frame. Any of them can be left out of a keyframe, and
+# the camera is smoothly moved through the keyframes
+# that do have them:
+#
+#   {"frames": 120,
+#    "keyframes": [{"frame": 0, "position": [0, 0, 3], "direction": [0, 1, 0]},
+#                  {"frame": 60, "position": [10, 200, 12], "fov": 40},
+#                  {"frame": 119, "position": [0, 240, 30], "direction": [0, 1, -0.5]}]}
+
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from functools import partial
+from time import time
+import json
+import os
+from Utility.Vector import Vector
+from Utility.Framebuffer import Framebuffer
+import Utility.Color as Color
+import Camera
+import Parallel
+import Profiler
+import Writer
+
+# What a keyframe can set, and how many numbers each takes
+FIELDS = (('position', 3), ('direction', 3), ('up', 3), ('fov', 1))
+
+#MARK: Camera paths
+
+def _curve(keys, frame):
+    # The value at frame of a Catmull-Rom spline through keys, a sorted list of (frame, values).
+    # The curve passes through every key, and holds still before the first and after the last
+    if frame <= keys[0][0]:
+        return keys[0][1]
+    if frame >= keys[-1][0]:
+        return keys[-1][1]
+
+    after = next(index for index, key in enumerate(keys) if key[0] > frame)
+    (t0, p0), (t1, p1) = keys[after - 1], keys[after]
+
+    def tangent(index):
+        # How fast the values change at a key, judged by its neighbours
+        before, beyond = keys[max(index - 1, 0)], keys[min(index + 1, len(keys) - 1)]
+        return [(b - a) / (beyond[0] - before[0]) for a, b in zip(before[1], beyond[1])]
+
+    m0, m1 = tangent(after - 1), tangent(after)
+    span = t1 - t0
+    s = (frame - t0) / span
+
+    # Cubic Hermite basis
+    h00 = 2 * s ** 3 - 3 * s ** 2 + 1
+    h10 = s ** 3 - 2 * s ** 2 + s
+    h01 = -2 * s ** 3 + 3 * s ** 2
+    h11 = s ** 3 - s ** 2
+    return [h00 * a + h10 * span * ma + h01 * b + h11 * span * mb for a, ma, b, mb in zip(p0, m0, p1, m1)]
+
+def load(path):
+    # The number of frames in the path in the file, and the keys of each field, by name
+    with open(path) as file:
+        description = json.load(file)
+
+    keyframes = description.get("keyframes") if isinstance(description, dict) else None
+    if not keyframes or not isinstance(keyframes, list):
+        raise ValueError("A camera path needs a list of keyframes")
+
+    keys = {name: [] for name, _ in FIELDS}
+    for number, keyframe in enumerate(keyframes):
+        if not isinstance(keyframe, dict) or not isinstance(keyframe.get("frame"), int) or keyframe["frame"] < 0:
+            raise ValueError("keyframe {} needs a frame number".format(number))
+        for name, count in FIELDS:
+            if name not in keyframe:
+                continue
+            values = keyframe[name] if count > 1 else [keyframe[name]]
+            if (not isinstance(values, list) or len(values) != count
+                    or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values)):
+                raise ValueError("keyframe {} '{}' should be {} numbers".format(number, name, count))
+            keys[name].append((keyframe["frame"], [float(value) for value in values]))
+
+    for name, _ in FIELDS:
+        keys[name].sort(key=lambda key: key[0])
+        if len(set(frame for frame, _ in keys[name])) < len(keys[name]):
+            raise ValueError("'{}' is set twice for the same frame".format(name))
+
+    frames = description.get("frames", max(keyframe["frame"] for keyframe in keyframes) + 1)
+    if not isinstance(frames, int) or frames < 1:
+        raise ValueError("A camera path needs at least one frame")
+    return frames, keys
+
+def views(path, camera):
+    # The (position, direction, up, fov) of the camera in every frame of the path in the file,
+    # keeping anything the path doesn't set where the scene put it
+    frames, keys = load(path)
+    start = {'position': list(camera.position), 'direction': list(camera.direction), 'up': list(camera.up), 'fov': [camera.fov]}
+    for name, _ in FIELDS:
+        keys[name] = keys[name] or [(0, start[name])]
+
+    path = []
+    for frame in range(frames):
+        position, direction, up, fov = (_curve(keys[name], frame) for name, _ in FIELDS)
+        path.append((Vector._make(position), Vector._make(direction), Vector._make(up), fov[0]))
+    return path
+
+#MARK: Rendering
+
+def _save(framebuffer, name, extension, extras):
+    # Writes out a finished frame and any extra images, while the next frame renders
+    with Profiler.stage("export"):
+        with open(name + extension, 'wb') as file:
+            writer = Writer.create(file, extension, framebuffer.width, framebuffer.height)
+            if writer:
+                Writer.Stream(framebuffer, writer).finish()
+            else:
+                Color.save(framebuffer.develop()[0], file, extension)
+
+        for extra, image in framebuffer.extras(extras).items():
+            image.save("{} {}.png".format(name, extra), "PNG")
+
+def capture(scene, camera, params, renderer=Camera.render_tile, farm=None, cache=None):
+    # Renders every frame of the path in params.animate, saving them as numbered copies of params.output
+    path = views(params.animate, camera)
+    stem, extension = os.path.splitext(params.output)
+    digits = max(4, len(str(len(path) - 1)))
+
+    # The workers keep their copy of the scene from one frame to the next
+    pool = Parallel.Pool(scene, params.multi) if params.multi > 1 and not farm else None
+
+    # Two framebuffers take turns, so one frame can be saved while the next is traced into the other
+    framebuffers = [Framebuffer(camera.width, camera.height, shared=pool is not None, guides=camera.guides) for _ in range(2)]
+    saving = [None, None]
+    begin = time()
+
+    try:
+        with ThreadPoolExecutor(1) as encoder:
+            for frame, view in enumerate(path):
+                turn = frame % 2
+                framebuffer = framebuffers[turn]
+                if saving[turn]:
+                    # Wait for the frame before last to be written out before drawing over it
+                    saving[turn].result()
+                framebuffer.clear()
+
+                shot = copy(camera)
+                shot.aim(*view)
+                # The pool stands in for a farm, rendering straight into this frame's framebuffer
+                workers = farm or (partial(pool.render, renderer, framebuffer=framebuffer) if pool else None)
+
+                rays = 0
+                with Profiler.stage("render", frame=frame):
+                    if cache:
+                        results = Camera.render_cached(scene, shot, cache, 1, renderer, workers, framebuffer)
+                    else:
+                        results = Camera.render(scene, shot, 1, renderer, workers, framebuffer)
+                    for result in results:
+                        rays += result.rays
+
+                name = "{} {:0{}d}".format(stem, frame, digits)
+                saving[turn] = encoder.submit(_save, framebuffer, name, extension, params.extras)
+
+                if params.verbose:
+                    print("Frame {}: {} rays, {:.2f}s elapsed".format(frame, rays, time() - begin))
+
+            for future in saving:
+                if future:
+                    future.result()
+    finally:
+        if pool:
+            pool.close()
+        for framebuffer in framebuffers:
+            framebuffer.close()
+
+    print("Total time for {} frames: {:.2f}s".format(len(path), time() - begin))
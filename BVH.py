@@ -0,0 +1,285 @@
+##########
+# BVH.py #
+##########
+# A bounding volume hierarchy sorts the bounded shapes
+# of a scene into a tree of nested boxes. A ray only has
+# to test the shapes inside the boxes it passes through,
+# so with thousands of shapes each ray does roughly
+# logarithmic work instead of checking every shape.
+#
+# A hierarchy pickles to a compact form, with its nodes
+# and the numbers inside its shapes packed into flat
+# arrays. Loading that back only rebuilds the nodes;
+# each shape is put back together the first time a ray
+# gets as far as testing it, so even scenes with
+# hundreds of thousands of shapes load in moments.
+
+from array import array
+from collections import namedtuple
+from itertools import repeat
+from Shapes import Shape
+
+def _union(lhs, rhs):
+    return (tuple(map(min, lhs[0], rhs[0])), tuple(map(max, lhs[1], rhs[1])))
+
+def _slab(lower, upper, origin, inverse, near, far):
+    # Clips [near, far] against the box one axis at a time, returns False if nothing is left
+    for lo, hi, o, i in zip(lower, upper, origin, inverse):
+        t1 = (lo - o) * i
+        t2 = (hi - o) * i
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > near:
+            near = t1
+        if t2 < far:
+            far = t2
+        if near > far:
+            return False
+    return True
+
+class _Packed(namedtuple('_Packed', 'bvh index')):
+    """Stands in for a shape that is still packed away, and unpacks it the first time it's tested"""
+
+    __slots__ = ()
+
+    def _shape(self):
+        shape = self.bvh.shapes[self.index]
+        return self.bvh._unpack(self.index) if shape is self else shape
+
+    def intersect_distance(self, ray, near, far):
+        return self._shape().intersect_distance(ray, near, far)
+
+    def intersection(self, ray, distance):
+        return self._shape().intersection(ray, distance)
+
+    def occludes(self, ray, near, far):
+        return self._shape().occludes(ray, near, far)
+
+    def bounds(self):
+        return self._shape().bounds()
+
+def _state(shape):
+    # A shape's attributes, as it would pickle them
+    return shape.__getstate__() if hasattr(shape, "__getstate__") else vars(shape)
+
+def _layout(shape):
+    # How a shape's attributes are laid out as numbers: the name of each, what it's rebuilt
+    # with (a number type, a tuple type, or None for anything else) and how many numbers it takes
+    layout = []
+    for name, value in sorted(_state(shape).items()):
+        if isinstance(value, (bool, int, float)):
+            layout.append((name, type(value), None))
+        elif isinstance(value, tuple) and all(type(item) is float for item in value):
+            layout.append((name, type(value), len(value)))
+        else:
+            layout.append((name, None, None))
+    return tuple(layout)
+
+class BVH(Shape):
+    """A tree of bounding boxes over bounded shapes, which intersects like a single shape"""
+
+    def __init__(self, shapes, leaf_size=4):
+        self.leaf_size = leaf_size
+        # Each node is (lower, upper, start, end, right), where a leaf has right set to None
+        # and owns shapes[start:end], and an inner node's left child is the next node over
+        self.nodes = []
+        self.shapes = []
+
+        entries = []
+        for shape in shapes:
+            lower, upper = shape.bounds()
+            entries.append((shape, (tuple(lower), tuple(upper)), tuple((l + u) / 2 for l, u in zip(lower, upper))))
+
+        if entries:
+            self._build(entries)
+
+    def _build(self, entries):
+        bounds = entries[0][1]
+        for entry in entries[1:]:
+            bounds = _union(bounds, entry[1])
+
+        node = len(self.nodes)
+        self.nodes.append(None)
+
+        if len(entries) <= self.leaf_size:
+            start = len(self.shapes)
+            self.shapes.extend(entry[0] for entry in entries)
+            self.nodes[node] = (bounds[0], bounds[1], start, len(self.shapes), None)
+            return
+
+        # Split at the median along whichever axis the centroids are most spread out on
+        spans = [max(entry[2][axis] for entry in entries) - min(entry[2][axis] for entry in entries) for axis in range(3)]
+        axis = spans.index(max(spans))
+        entries.sort(key=lambda entry: entry[2][axis])
+        middle = len(entries) // 2
+
+        self._build(entries[:middle])
+        right = len(self.nodes)
+        self._build(entries[middle:])
+
+        self.nodes[node] = (bounds[0], bounds[1], 0, 0, right)
+
+    def bounds(self):
+        return self.nodes[0][:2] if self.nodes else None
+
+    #MARK: Packing
+
+    def __getstate__(self):
+        # A hierarchy that was itself loaded from a packed state hands back that same state
+        if hasattr(self, "_state"):
+            return self._state
+
+        bounds = array('d')
+        ranges = array('q')
+        for lower, upper, start, end, right in self.nodes:
+            bounds.extend(lower + upper)
+            ranges.extend((start, end))
+
+        # Every shape is its class and layout, and its attributes as a run of numbers.
+        # Anything that isn't a number, like a material, is kept once in objects and
+        # its place in that list goes in the numbers instead
+        kinds, kind_of, objects, object_of = [], {}, [], {}
+        shapes, offsets, values = array('H'), array('q'), array('d')
+        for shape in self.shapes:
+            layout = _layout(shape)
+            kind = (type(shape), layout)
+            if kind not in kind_of:
+                kind_of[kind] = len(kinds)
+                kinds.append(kind)
+            shapes.append(kind_of[kind])
+            offsets.append(len(values))
+
+            state = _state(shape)
+            for name, form, length in layout:
+                value = state[name]
+                if form is None:
+                    if id(value) not in object_of:
+                        object_of[id(value)] = len(objects)
+                        objects.append(value)
+                    values.append(object_of[id(value)])
+                elif length is None:
+                    values.append(value)
+                else:
+                    values.extend(value)
+
+        return {"leaf_size": self.leaf_size, "bounds": bounds, "ranges": ranges,
+                "rights": [node[4] for node in self.nodes], "kinds": kinds,
+                "objects": objects, "shapes": shapes, "offsets": offsets, "values": values}
+
+    def __setstate__(self, state):
+        self._state = state
+        self.leaf_size = state["leaf_size"]
+
+        # Each node's lower and upper corners are the next two runs of three in bounds.
+        # Everything here is zipped together without a Python loop, for speed
+        corners = zip(*[iter(state["bounds"])] * 3)
+        ranges = state["ranges"]
+        self.nodes = list(zip(corners, corners, ranges[0::2], ranges[1::2], state["rights"]))
+
+        # Shapes are only unpacked once something needs them
+        self.shapes = list(map(tuple.__new__, repeat(_Packed), zip(repeat(self), range(len(state["shapes"])))))
+
+    def _unpack(self, index):
+        # Puts a shape back together from its numbers, and swaps it in for its stand-in
+        state = self._state
+        cls, layout = state["kinds"][state["shapes"][index]]
+        values, offset = state["values"], state["offsets"][index]
+
+        attributes = {}
+        for name, form, length in layout:
+            if form is None:
+                attributes[name] = state["objects"][int(values[offset])]
+                offset += 1
+            elif length is None:
+                attributes[name] = form(values[offset])
+                offset += 1
+            else:
+                attributes[name] = tuple.__new__(form, values[offset:offset + length])
+                offset += length
+
+        shape = cls.__new__(cls)
+        if hasattr(shape, "__setstate__"):
+            shape.__setstate__(attributes)
+        else:
+            shape.__dict__.update(attributes)
+        self.shapes[index] = shape
+        return shape
+
+    def unpacked(self):
+        # Every shape in the hierarchy, unpacking any that haven't been yet
+        for index, shape in enumerate(self.shapes):
+            if isinstance(shape, _Packed):
+                self._unpack(index)
+        return self.shapes
+
+    def nearest_hit(self, ray, near, far):
+        if not self.nodes:
+            return None
+
+        origin = ray.origin
+        inverse = tuple(1.0 / d if d else float('inf') for d in ray.direction)
+
+        closest = None
+        stack = [0]
+
+        while stack:
+            node = stack.pop()
+            lower, upper, start, end, right = self.nodes[node]
+
+            if not _slab(lower, upper, origin, inverse, near, far):
+                continue
+
+            if right is None:
+                for shape in self.shapes[start:end]:
+                    distance = shape.intersect_distance(ray, near, far)
+                    if distance is not None:
+                        closest = shape
+                        far = distance
+            else:
+                stack.append(right)
+                stack.append(node + 1)
+
+        return (far, closest) if closest else None
+
+    def intersect_distance(self, ray, near, far):
+        hit = self.nearest_hit(ray, near, far)
+        return hit[0] if hit else None
+
+    def intersection(self, ray, distance):
+        # Only the shape that was hit knows what its intersection looks like, so find it again.
+        # The window is widened a hair, in case rounding puts the hit just outside its box
+        slack = abs(distance) * 1e-9 + 1e-12
+        hit = self.nearest_hit(ray, distance - slack, distance + slack)
+        return hit[1].intersection(ray, hit[0]) if hit else None
+
+    def occludes(self, ray, near, far):
+        # Like nearest_hit, but stops at the first hit it finds
+        if not self.nodes:
+            return False
+
+        origin = ray.origin
+        inverse = tuple(1.0 / d if d else float('inf') for d in ray.direction)
+        stack = [0]
+
+        while stack:
+            node = stack.pop()
+            lower, upper, start, end, right = self.nodes[node]
+
+            if not _slab(lower, upper, origin, inverse, near, far):
+                continue
+
+            if right is None:
+                if any(shape.occludes(ray, near, far) for shape in self.shapes[start:end]):
+                    return True
+            else:
+                stack.append(right)
+                stack.append(node + 1)
+
+        return False
+
+def accelerate(scene):
+    # Unbounded shapes like planes are always tested, everything else goes in the tree
+    unbounded = [shape for shape in scene if shape.bounds() is None]
+    bounded = [shape for shape in scene if shape.bounds() is not None]
+
+    return unbounded + [BVH(bounded)] if bounded else unbounded
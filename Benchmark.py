@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+################
+# Benchmark.py #
+################
+# Renders a fixed set of workloads with pinned seeds
+# and reports how fast each one went as JSON, so that
+# the effect of a change can be measured rather than
+# guessed at. Given the results of an earlier run, it
+# will also point out any workloads that got slower.
+#
+# Every workload runs in a fresh process, so that peak
+# memory is measured for that workload alone. With
+# --multi, it's the biggest of that process and each
+# of its workers.
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from optparse import OptionParser, Values
+from statistics import mean, median
+from time import time
+import json
+import platform
+import resource
+import sys
+import Camera
+import Scene
+from Utility.Framebuffer import Framebuffer
+
+Workload = namedtuple('Workload', 'name prepared num_spheres resolution samples depth')
+
+WORKLOADS = [
+    Workload("prepared", True, 0, (64, 48), 4, 5),
+    Workload("prepared-shallow", True, 0, (64, 48), 4, 2),
+    Workload("prepared-deep", True, 0, (64, 48), 4, 10),
+    Workload("prepared-samples", True, 0, (64, 48), 16, 5),
+    Workload("random-100", False, 100, (64, 48), 4, 5),
+    Workload("random-1000", False, 1000, (64, 48), 4, 5),
+    Workload("random-10000", False, 10000, (64, 48), 4, 5),
+]
+
+# The seed used for both the scene and the samples
+SEED = 435
+
+def run(workload, packet, threads):
+    # Renders one workload and measures it; this is called in its own process
+    params = Values(dict(scene=None, prepared=workload.prepared, seed=SEED, num_spheres=workload.num_spheres,
+                         resolution=workload.resolution, fov=95.0, samples=workload.samples,
+                         depth=workload.depth, frustum=(0.1, 1000), roulette=None, cutoff=None, adaptive=None, min_samples=4,
+                         sampler="random", packet=packet, denoise=False, verbose=False))
+
+    begin = time()
+    scene, camera = Scene.build(params)
+    build_time = time() - begin
+
+    framebuffer = Framebuffer(camera.width, camera.height, shared=threads > 1)
+    rays = 0
+
+    begin = time()
+    for result in Camera.render(scene, camera, threads, Scene.renderer(params), framebuffer=framebuffer):
+        rays += result.rays
+    seconds = time() - begin
+
+    times = list(framebuffer.times)
+    framebuffer.close()
+
+    # With threads the tracing happens in pool workers, which have all been joined by now,
+    # so the peak is whichever is bigger of this process and its hungriest worker.
+    # Linux reports kilobytes, macOS reports bytes
+    peak = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+    return {
+        "workload": workload._asdict(),
+        "build_seconds": build_time,
+        "seconds": seconds,
+        "rays": rays,
+        "rays_per_second": rays / seconds,
+        "time_per_pixel": {"mean": mean(times), "median": median(times), "max": max(times)},
+        "peak_memory_kb": peak // (1024 if sys.platform == "darwin" else 1),
+    }
+
+def measure(workload, packet, threads, repeat):
+    # Keeps the fastest of several runs, each in a brand new process
+    best = None
+    for _ in range(repeat):
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+            result = pool.submit(run, workload, packet, threads).result()
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+def compare(results, baseline, tolerance):
+    # Lists every workload that is slower or hungrier than the baseline by more than tolerance
+    previous = {result["workload"]["name"]: result for result in baseline["results"]}
+    regressions = []
+
+    for result in results:
+        before = previous.get(result["workload"]["name"])
+        if before is None:
+            continue
+
+        speed = result["rays_per_second"] / before["rays_per_second"]
+        memory = result["peak_memory_kb"] / before["peak_memory_kb"]
+
+        if speed < 1 - tolerance:
+            regressions.append("{}: {:.0f} rays/s, down from {:.0f}".format(
+                result["workload"]["name"], result["rays_per_second"], before["rays_per_second"]))
+        if memory > 1 + tolerance:
+            regressions.append("{}: {} KB peak memory, up from {}".format(
+                result["workload"]["name"], result["peak_memory_kb"], before["peak_memory_kb"]))
+
+    return regressions
+
+def main():
+    parser = OptionParser(version="1.0", usage="%prog [options]")
+
+    parser.add_option("-o", "--output", metavar="FILENAME",
+                      help="Write the JSON report here instead of to stdout.")
+    parser.add_option("-w", "--workload", action="append", metavar="NAME",
+                      help="Only run this workload; can be given more than once. Available: {}.".format(
+                          ", ".join(workload.name for workload in WORKLOADS)))
+    parser.add_option("-r", "--repeat", type="int", default=1,
+                      help="Run each workload this many times and keep the fastest. Default: 1.")
+    parser.add_option("-m", "--multi", metavar="THREADS", type="int", default=1,
+                      help="Number of worker processes to render each workload with. Default: 1.")
+    parser.add_option("--packet", action="store_true", default=False,
+                      help="Benchmark the vectorized NumPy engine.")
+    parser.add_option("-b", "--baseline", metavar="FILENAME",
+                      help="Compare against the report from an earlier run, and fail if anything regressed.")
+    parser.add_option("-t", "--tolerance", type="float", default=0.1,
+                      help="How much worse than the baseline a workload can be before it counts as a regression. Default: 0.1.")
+
+    params, args = parser.parse_args()
+
+    if len(args) != 0:
+        parser.error("Too many arguments")
+
+    workloads = WORKLOADS
+    if params.workload:
+        unknown = set(params.workload) - set(workload.name for workload in WORKLOADS)
+        if unknown:
+            parser.error("Unknown workloads: {}".format(", ".join(sorted(unknown))))
+        workloads = [workload for workload in WORKLOADS if workload.name in params.workload]
+
+    baseline = None
+    if params.baseline:
+        try:
+            with open(params.baseline) as file:
+                baseline = json.load(file)
+        except (OSError, ValueError):
+            parser.error("Unable to read baseline '{}'".format(params.baseline))
+
+    parser.destroy()
+
+    results = []
+    for workload in workloads:
+        result = measure(workload, params.packet, params.multi, params.repeat)
+        print("{}: {:.2f}s, {:.0f} rays/s".format(workload.name, result["seconds"], result["rays_per_second"]), file=sys.stderr)
+        results.append(result)
+
+    report = {
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "processor": platform.processor()},
+        "settings": {"seed": SEED, "packet": params.packet, "multi": params.multi, "repeat": params.repeat},
+        "results": results,
+    }
+
+    if params.output:
+        with open(params.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if baseline:
+        regressions = compare(results, baseline, params.tolerance)
+        for regression in regressions:
+            print("Regression in {}".format(regression), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
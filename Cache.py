@@ -0,0 +1,144 @@
+############
+# Cache.py #
+############
+# Keeps finished tiles on disk, so rendering the same
+# scene with the same camera again is just a matter of
+# reading them back. Tiles are stored as their running
+# totals rather than as an image, which means a render
+# that asks for more samples than were cached only has
+# to trace the extra samples and add them in.
+#
+# Tiles are filed under a hash of everything that
+# decides what they look like: the shapes and their
+# materials, the camera, its seed and sampler, and the
+# engine. Every sample draws the same numbers wherever
+# and whenever it's rendered, so cached samples are
+# exactly the samples that would be traced again.
+#
+# The cache is kept under a size budget by deleting the
+# tiles that were used least recently. Everything lives
+# in a folder of its own inside the cache directory, and
+# nothing but tiles in it is ever deleted, so pointing
+# --cache at a folder that has other things in it is safe.
+
+from array import array
+from hashlib import blake2b
+import os
+import re
+
+# Bumped whenever the way tiles are rendered changes, so old tiles aren't mistaken for new ones
+VERSION = 1
+
+# The folder inside the cache directory that the tiles are kept in, one folder per key
+TILES = "raytracer-tiles"
+KEY = re.compile(r"[0-9a-f]{32}$")
+
+def _feed(digest, value):
+    # Adds a canonical description of a value to the hash, looking inside objects
+    if value is None or isinstance(value, (bool, int, float, str)):
+        digest.update(repr(value).encode())
+    elif isinstance(value, (tuple, list)):
+        digest.update("{}[".format(type(value).__name__).encode())
+        for item in value:
+            _feed(digest, item)
+            digest.update(b",")
+        digest.update(b"]")
+    elif isinstance(value, dict):
+        digest.update(b"{")
+        for name in sorted(value):
+            _feed(digest, name)
+            digest.update(b":")
+            _feed(digest, value[name])
+            digest.update(b",")
+        digest.update(b"}")
+    elif isinstance(value, (bytes, array)):
+        digest.update(bytes(value))
+    elif isinstance(value, type):
+        digest.update("{}.{}".format(value.__module__, value.__qualname__).encode())
+    else:
+        # Objects that pickle to a state of their own, like hierarchies, are described by it
+        digest.update(type(value).__name__.encode())
+        _feed(digest, value.__getstate__() if hasattr(value, "__getstate__") else vars(value))
+
+def key(scene, camera, renderer):
+    # The hash a render's tiles are filed under. How many samples are taken isn't part of it,
+    # unless pixels decide for themselves when to stop, since then more samples change which
+    # samples get taken
+    digest = blake2b(digest_size=16)
+    _feed(digest, VERSION)
+    _feed(digest, "{}.{}".format(renderer.__module__, renderer.__name__))
+    _feed(digest, scene)
+    _feed(digest, (camera.position, camera.origin, camera.i_hat, camera.j_hat, camera.width, camera.height,
+                   camera.depth, camera.frustum, camera.roulette, camera.cutoff, camera.seed, camera.sampler.key(), camera.threshold))
+    if camera.threshold:
+        _feed(digest, (camera.samples, camera.min_samples))
+    if camera.guides:
+        # Tiles with guides hold more planes
+        _feed(digest, "guides")
+    return digest.hexdigest()
+
+class Cache(object):
+    """A directory of rendered tiles, kept under a budget of bytes"""
+
+    def __init__(self, path, budget):
+        self.path = path
+        self.budget = budget
+        self._tiles = os.path.join(path, TILES)
+        os.makedirs(self._tiles, exist_ok=True)
+
+    def _file(self, key, tile):
+        return os.path.join(self._tiles, key, "{}-{}-{}-{}.tile".format(*tile))
+
+    def _entries(self):
+        # The folders of tiles the cache made, skipping anything else that ended up in there
+        return [entry for entry in os.scandir(self._tiles)
+                if KEY.match(entry.name) and entry.is_dir(follow_symlinks=False)]
+
+    def load(self, key, tile, size):
+        # The values stored for a tile, or None if there aren't size of them
+        path = self._file(key, tile)
+        try:
+            with open(path, 'rb') as file:
+                values = file.read()
+            # Reading a tile counts as using it
+            os.utime(path)
+        except OSError:
+            return None
+        return values if len(values) == size * 8 else None
+
+    def store(self, key, tile, values):
+        # Write to the side and swap it in, in case another render is reading the same tile
+        path = self._file(key, tile)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, 'wb') as file:
+            file.write(values)
+        os.replace(temporary, path)
+
+    def evict(self):
+        # Deletes the least recently used tiles until everything fits in the budget
+        files = []
+        entries = self._entries()
+        for entry in entries:
+            for tile in os.scandir(entry.path):
+                if tile.name.endswith(".tile") and tile.is_file(follow_symlinks=False):
+                    status = tile.stat(follow_symlinks=False)
+                    files.append((status.st_mtime, status.st_size, tile.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.budget:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        # Clear out any entries with no tiles left
+        for entry in entries:
+            try:
+                os.rmdir(entry.path)
+            except OSError:
+                # Not empty, or already gone
+                pass
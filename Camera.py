@@ -6,32 +6,75 @@
 # and I've tried to mark areas of interest
 
 from collections import namedtuple
+from itertools import repeat
+from operator import add
+from copy import copy
 from math import radians, tan, sqrt
-from random import uniform
 from time import time
-from Utility.Vector import cross, Ray
+from Utility.Vector import cross, unit, Ray
+import Utility.Streams as Streams
+import Sampler
 import Utility.Color as Color
+from Utility.Framebuffer import Framebuffer, GUIDES
+import Parallel
+import Profiler
+import Cache
+import Writer
 
 # Global settings
 scene_refraction_index = 1.0
-total_rays = 0
 
 # A frustum is a conical shape with the top chopped off
 Frustum = namedtuple('Frustum', 'near far')
 
+# A rectangular region of the image, the unit of work for rendering
+Tile = namedtuple('Tile', 'x y width height')
+
+# What comes back from rendering a tile; times and samples are per pixel, like pixels.
+# The profile is None unless profiling is on, and guides unless the camera records them
+TileResult = namedtuple('TileResult', 'tile pixels times samples rays profile guides', defaults=(None,))
+
 class Camera(object):
     """Holds the camera's parameters and calculates the screenspace coordinate frame"""
 
-    def __init__(self, position, direction, up, resolution, FOV, samples, depth, frustum):
-        direction = direction.unit()
-
-        self.position = position
+    def __init__(self, position, direction, up, resolution, FOV, samples, depth, frustum, threshold=None, min_samples=4, seed=0, sampler=None, roulette=None, cutoff=None, guides=False):
         self.width = resolution[0]
         self.height = resolution[1]
         self.samples = samples
         self.depth = depth
         self.frustum = Frustum._make(frustum)
 
+        # With a threshold, pixels stop taking samples once they've settled down,
+        # taking at least min_samples and at most samples
+        self.threshold = threshold
+        self.min_samples = min(max(min_samples, 2), samples)
+
+        # Every sample draws its random numbers from a stream keyed by the seed, its pixel and
+        # its number, counting from first_sample, so it comes out the same wherever it's rendered
+        self.seed = seed
+        self.first_sample = 0
+        # Which numbers each sample takes from its stream
+        self.sampler = sampler or Sampler.Independent()
+
+        # Paths stop early once they carry too little light to matter: past roulette bounces
+        # they play Russian roulette, and any path dimmer than cutoff is dropped outright
+        self.roulette = roulette
+        self.cutoff = cutoff
+
+        # With guides, tiles also bring back what each pixel's samples hit first, for the denoiser
+        self.guides = guides
+
+        self.aim(position, direction, up, FOV)
+
+    def aim(self, position, direction, up, FOV):
+        # Places the camera, which can be moved again between frames of an animation
+        direction = direction.unit()
+
+        self.position = position
+        self.direction = direction
+        self.up = up
+        self.fov = FOV
+
         # Calculate the screen dimensions given the FOV
         screen_width = tan(radians(FOV / 2.0))
         screen_height = (float(self.height) / float(self.width)) * screen_width
@@ -52,99 +95,341 @@ class Camera(object):
     def __str__(self):
         return "Camera (p: {}, w:{}, h: {}, ih: {}, jh: {})".format(self.position, self.width, self.height, abs(self.i_hat), abs(self.j_hat))
 
-def capture(scene, camera, verbose, draw_heatmap):
-    global total_rays
-    total_rays = 0
-
-    # Create the empty pixel array to convert to an image
-    pixels = []
-    metadata = []
-
+def tiles(camera, size=16):
+    # Cut the image up into square-ish tiles, left to right, top to bottom
+    for y in range(0, camera.height, size):
+        for x in range(0, camera.width, size):
+            yield Tile(x, y, min(size, camera.width - x), min(size, camera.height - y))
+
+def rows(values, width):
+    # Folds a flat list of pixels back up into rows
+    return [values[start:start + width] for start in range(0, len(values), width)]
+
+def converged(camera, count, total, squares):
+    # Checks whether the standard error of a pixel's mean brightness is under the threshold
+    if count < camera.min_samples:
+        return False
+    if count >= camera.samples:
+        return True
+
+    mean = total / count
+    variance = max(squares - count * mean ** 2, 0.0) / (count - 1)
+    return sqrt(variance / count) <= camera.threshold
+
+def render_tile(scene, camera, tile):
+    previous = Profiler.begin()
     begin = time()
 
-    # Build the image one pixel at a time
-    for y in range(camera.height):
-        pixels.append([])
-        metadata.append([])
-        for x in range(camera.width):
-            pixel, data = get_pixel(scene, camera, x, y)
-            pixels[y].append(pixel)
-            metadata[y].append(data)
+    coordinates = [(x, y) for y in range(tile.y, tile.y + tile.height) for x in range(tile.x, tile.x + tile.width)]
+
+    # Running totals for each pixel, brightness is kept separately to estimate the variance
+    colors = [Color.black] * len(coordinates)
+    brightness = [0.0] * len(coordinates)
+    squares = [0.0] * len(coordinates)
+    samples = [0] * len(coordinates)
+    times = [0.0] * len(coordinates)
+    guides = [(0.0,) * len(GUIDES)] * len(coordinates) if camera.guides else None
+
+    # Without a threshold every pixel takes all its samples in one go; with one,
+    # pixels take min_samples at a time until they converge
+    batch = camera.min_samples if camera.threshold else camera.samples
+    active = list(range(len(coordinates)))
+    rays = 0
+
+    # Where each pixel's random streams start from
+    keys = [Streams.pixel(camera.seed, x, y) for x, y in coordinates]
+
+    while active:
+        # Generate the next primary rays for every active pixel, samples of a pixel side by side
+        owners = []
+        sample_keys = []
+        for index in active:
+            first = camera.first_sample + samples[index]
+            count = min(batch, camera.samples - samples[index])
+            pixel = keys[index]
+            sample_keys.extend((pixel, sample, Streams.stream(pixel, sample)) for sample in range(first, first + count))
+            owners.extend([index] * count)
+
+        primaries = primary_rays(camera, coordinates, owners, sample_keys)
+        first = [None] * len(primaries) if guides else None
+        sample_colors, costs, casts = trace(scene, primaries, sample_keys, camera.sampler, camera.depth, camera.frustum,
+                                            camera.roulette, camera.cutoff, first)
+        rays += casts
+
+        if guides:
+            for index, hit in zip(owners, first):
+                guides[index] = tuple(map(add, guides[index], hit))
+
+        for index, color, cost in zip(owners, sample_colors, costs):
+            colors[index] = colors[index] + color
+            luminance = color.luminance()
+            brightness[index] += luminance
+            squares[index] += luminance ** 2
+            samples[index] += 1
+            times[index] += cost
+
+        if not camera.threshold:
+            break
+        active = [index for index in active if not converged(camera, samples[index], brightness[index], squares[index])]
 
-    print("Total tracing time: {:.2f}s".format(time() - begin))
+    pixels = []
 
-    if verbose:
-        per_pixel = float(total_rays)/float(camera.width * camera.height)
-        print("Total number of rays traced: {}, Average per pixel: {}".format(total_rays, per_pixel))
-        print("Mean time per pixel: [], Median: [], Max: []")
-        begin = time()
+    for index, pixel in enumerate(colors):
+        # Color correction
+        pixel = pixel / samples[index]
+        #TODO: check how this looks with transform
+        #pixel = pixel.apply_transform(sqrt)
 
-    # Convert our array from what is essentially a bitmap to an image
-    image = Color.image_from_pixels(pixels, (camera.width, camera.height))
-    heatmap = None
+        pixels.append(pixel)
 
-    if draw_heatmap:
-        heatmap = Color.heatmap_from_data(metadata, (camera.width, camera.height))
+    if guides:
+        guides = rows([tuple(value / count for value in totals) for totals, count in zip(guides, samples)], tile.width)
 
-    if verbose:
-        print("Image processing time: {:.2f}s".format(time() - begin))
+    if Profiler.current:
+        Profiler.current.span("tile", begin, time(), x=tile.x, y=tile.y)
 
-    return image, heatmap
+    return TileResult(tile, rows(pixels, tile.width), rows(times, tile.width), rows(samples, tile.width), rays, Profiler.end(previous), guides)
 
-def get_pixel(scene, camera, x, y):
-    pixel = Color.black
+def capture(scene, camera, verbose, extras=(), threads=1, renderer=render_tile, farm=None, cache=None, framebuffer=None, writer=None):
+    # Returns the image and any extra images; with a writer, the image is written out
+    # a strip at a time as the tiles come in, and there's no image to return
+    # Create the empty framebuffer to convert to an image, unless one was given; worker processes can write straight into it
+    if framebuffer is None:
+        framebuffer = Framebuffer(camera.width, camera.height, shared=threads > 1 and not farm, guides=camera.guides)
+    rays = 0
+    stream = Writer.Stream(framebuffer, writer) if writer else None
 
     begin = time()
 
-    # Collect samples of the scene for this current pixel
-    for _ in range(camera.samples):
-        # Randomly generate offsets for the current subsample
-        x_n = x + uniform(0, 1)
-        y_n = y + uniform(0, 1)
+    # Tiles can come back in any order, and the framebuffer puts them in by position
+    with Profiler.stage("render"):
+        if cache:
+            results = render_cached(scene, camera, cache, threads, renderer, farm, framebuffer)
+        else:
+            results = render(scene, camera, threads, renderer, farm, framebuffer)
+        for result in results:
+            rays += result.rays
+            if stream:
+                stream.add(result.tile)
 
-        # Get the subsample position and construct a ray from it
-        screen_coordinate = camera.origin + camera.i_hat * x_n - camera.j_hat * y_n
-        sample = Ray(camera.position, screen_coordinate)
-
-        pixel = pixel + trace(scene, sample, camera.depth, camera.frustum)
+    print("Total tracing time: {:.2f}s".format(time() - begin))
+    if verbose or Profiler.enabled():
+        times = Profiler.pixel_times(framebuffer.times)
 
-    # Color correction
-    pixel = pixel / camera.samples
-    #TODO: check how this looks with transform
-    #pixel = pixel.apply_transform(sqrt)
+    if verbose:
+        per_pixel = float(rays)/float(camera.width * camera.height)
+        print("Total number of rays traced: {}, Average per pixel: {}".format(rays, per_pixel))
+        total_samples = sum(framebuffer.samples)
+        print("Total number of samples: {}, Average per pixel: {}".format(total_samples, float(total_samples)/float(camera.width * camera.height)))
+        print("Mean time per pixel: {mean:.6f}s, Median: {median:.6f}s, Max: {max:.6f}s".format(**times))
+        begin = time()
 
-    endtime = time()
+    with Profiler.stage("export"):
+        if stream:
+            stream.finish()
+            image, images = None, framebuffer.extras(extras)
+        else:
+            image, images = framebuffer.develop(extras)
+    framebuffer.close()
 
-    return pixel, endtime - begin
+    if verbose:
+        print("Image processing time: {:.2f}s".format(time() - begin))
 
-def trace(scene, ray, depth, frustum):
-    # Base case; try changing the color and seeing what you get!
-    if depth <= 0:
-        return Color.black
+    return image, images
+
+def render(scene, camera, threads=1, renderer=render_tile, farm=None, framebuffer=None, todo=None):
+    # Build the image one tile at a time, either here, across a process pool,
+    # or by handing the tiles to a farm that will render them somewhere else.
+    # Each finished tile is added to the framebuffer, if there is one.
+    # Every tile gets rendered, unless todo says which ones
+    todo = list(tiles(camera)) if todo is None else todo
+    if farm:
+        results = farm(camera, todo)
+    elif threads > 1:
+        results = Parallel.render(renderer, scene, camera, todo, threads, framebuffer)
+    else:
+        results = (renderer(scene, camera, tile) for tile in todo)
+
+    for result in results:
+        Profiler.merge(result.profile)
+        # Workers sharing the framebuffer have already written their pixels in
+        if framebuffer is not None and result.pixels is not None:
+            framebuffer.add(result)
+        yield result
+
+def render_cached(scene, camera, cache, threads=1, renderer=render_tile, farm=None, framebuffer=None):
+    # Like render, but starts each tile off with whatever the cache has for it, only
+    # traces the samples that are missing, and files every finished tile away
+    key = Cache.key(scene, camera, renderer)
+    missing = {}
+    keep = set()
+
+    for tile in tiles(camera):
+        values = cache.load(key, tile, framebuffer.planes * tile.width * tile.height)
+        taken = 0
+        if values is not None:
+            framebuffer.write(tile, values)
+            # Pixels that decide for themselves when to stop finish short of samples, but the key
+            # already pins down how many they could take, so any tile that was stored is done
+            taken = camera.samples if camera.threshold else int(framebuffer.fewest(tile))
+            if taken > camera.samples:
+                # Samples can't be taken back out, so start over, but don't lose the better tile
+                framebuffer.write(tile, bytes(len(values)))
+                keep.add(tile)
+                taken = 0
+        if taken < camera.samples:
+            missing.setdefault(taken, []).append(tile)
+
+    # Tiles that are missing the same samples get rendered together
+    for taken, todo in sorted(missing.items()):
+        sweep = copy(camera)
+        sweep.first_sample = camera.first_sample + taken
+        sweep.samples = camera.samples - taken
+        sweep.min_samples = min(camera.min_samples, sweep.samples)
+
+        for result in render(scene, sweep, threads, renderer, farm, framebuffer, todo):
+            if result.tile not in keep:
+                cache.store(key, result.tile, framebuffer.read(result.tile))
+            yield result
+
+    cache.evict()
+
+def primary_rays(camera, coordinates, owners, keys):
+    # A ray for each sample, through the pixel at coordinates[owner]
+    rays = []
+    ox, oy, oz = camera.origin
+    ix, iy, iz = camera.i_hat
+    jx, jy, jz = camera.j_hat
+
+    # The first pair of numbers a sample draws place it within its pixel
+    offsets = camera.sampler.pairs(keys, 0)
+
+    for owner, (u, v) in zip(owners, offsets):
+        x, y = coordinates[owner]
+        x_n = x + u
+        y_n = y + v
 
-    # Check to see if our ray hits an object, or just shoots into space
-    intersect = cast_ray(scene, ray, frustum)
-    if intersect:
-        #return Color.black
-        # Get the color of that object and the bounce vector for recursion if there is recursion
-        sample, bounce = intersect.material.scatter(ray, intersect, scene_refraction_index)
+        # Get the subsample position and construct a ray from it
+        rays.append(Ray(camera.position, unit(ox + ix * x_n - jx * y_n,
+                                              oy + iy * x_n - jy * y_n,
+                                              oz + iz * x_n - jz * y_n), True))
+
+    return rays
+
+def trace(scene, rays, keys, sampler, depth, frustum, roulette=None, cutoff=None, first=None):
+    # Rather than recursing on each ray, this works on a whole generation of
+    # rays at a time: intersect all of them, scatter all of them, then retire
+    # the ones that are done. Returns the color each ray brought back, along
+    # with how much of the tracing time was spent on it, and how many rays were cast.
+    # Each ray draws its random numbers from the sampler, for the sample keys of the same index.
+    # Paths that have faded can be ended early, see terminate.
+    # If first is given, it's filled in with the guides of what each ray hits first.
+    profile = Profiler.current
+    casts = 0
+    colors = [Color.black] * len(rays)
+    throughput = [Color.white] * len(rays)
+    costs = [0.0] * len(rays)
+    paths = list(enumerate(rays))
+
+    # Base case; any path still bouncing after depth generations stays black.
+    # Try changing the color in colors above and seeing what you get!
+    for generation in range(depth):
+        if not paths:
+            break
+
+        casts += len(paths)
+        begin = time()
 
-        #TODO: check how this looks with color
-        # Here is the actual color blending; it's very simple
-        return sample * trace(scene, bounce, depth - 1, frustum) if bounce else Color.black
-    else:
-        #return Color.white
-        return Color.sky_gradient(ray.direction.z)
+        # The numbers each path's bounce can draw on, all in one go
+        draws = sampler.pairs([keys[index] for index, _ in paths], generation + 1)
+
+        # Check to see if our rays hit an object, or just shoot into space
+        hits = {}
+        for (index, ray), uniforms in zip(paths, draws):
+            intersect = cast_ray(scene, ray, frustum)
+            if intersect:
+                hits.setdefault(intersect.material, []).append((index, ray, intersect, uniforms))
+            else:
+                #colors[index] = throughput[index] * Color.white
+                colors[index] = throughput[index] * Color.sky_gradient(ray.direction.z)
+
+            if first is not None and generation == 0:
+                if intersect:
+                    first[index] = tuple(intersect.material.color) + tuple(intersect.normal) + (intersect.distance,)
+                else:
+                    first[index] = tuple(Color.sky_gradient(ray.direction.z)) + (0.0, 0.0, 0.0, frustum.far)
+
+        middle = time()
+
+        # Get the color of each object hit and the bounce for the next generation,
+        # handing every material all of its rays at once
+        survivors = []
+        for material, group in hits.items():
+            indices, incoming, intersects, uniforms = zip(*group)
+            scattered = material.scatter_all(incoming, intersects, scene_refraction_index, uniforms)
+            for index, (sample, bounce) in zip(indices, scattered):
+                if bounce:
+                    #TODO: check how this looks with color
+                    # Here is the actual color blending; it's very simple
+                    throughput[index] = throughput[index] * sample
+                    survivors.append((index, bounce))
+
+        if cutoff or (roulette is not None and generation + 1 >= roulette):
+            survivors = terminate(survivors, throughput, keys, generation + 1, roulette, cutoff)
+
+        end = time()
+        if profile:
+            profile.count("rays per depth", generation, len(paths))
+            for material, group in hits.items():
+                profile.count("hits per material", type(material).__name__, len(group))
+            profile.span("intersect", begin, middle, depth=generation)
+            profile.span("scatter", middle, end, depth=generation)
+
+        # Split the time this generation took evenly among its rays
+        share = (end - begin) / len(paths)
+        for index, _ in paths:
+            costs[index] += share
+
+        paths = survivors
+
+    return colors, costs, casts
+
+def terminate(paths, throughput, keys, bounce, roulette, cutoff):
+    # Ends paths that would bring back next to nothing. Any path whose brightest
+    # channel is below the cutoff is dropped, which darkens the image a little.
+    # Past the roulette bounce, each path carries on with a chance equal to its
+    # brightest channel instead, and the ones that do are brightened to make up
+    # for the ones that didn't, so on average the image comes out the same
+    playing = roulette is not None and bounce >= roulette
+    chances = Streams.decisions([keys[index][2] for index, _ in paths], bounce) if playing else repeat(0.0)
+
+    survivors = []
+    for (index, ray), chance in zip(paths, chances):
+        strongest = max(throughput[index])
+        if cutoff and strongest < cutoff:
+            Profiler.count("paths ended", "cutoff")
+            continue
+        if playing and strongest < 1.0:
+            if chance >= strongest:
+                Profiler.count("paths ended", "roulette")
+                continue
+            throughput[index] = throughput[index] / strongest
+        survivors.append((index, ray))
+    return survivors
 
 def cast_ray(scene, ray, frustum):
-    global total_rays
-    total_rays += 1
-
     closest = None
+    near, far = frustum
 
     for shape in scene:
-        intersect = shape.intersect_ray(ray, Frustum(frustum.near, (closest.distance if closest else frustum.far)))
-        if intersect:
-            closest = intersect
+        hit = shape.nearest_hit(ray, near, far)
+        if hit:
+            closest = hit
+            far = hit[0]
+
+    # Only the shape that was actually hit has its point and normal worked out
+    return closest[1].intersection(ray, closest[0]) if closest else None
 
-    return closest
+def occluded(scene, ray, frustum):
+    # Any-hit query, for shadow rays and the like where it only matters whether something is in the way
+    return any(shape.occludes(ray, frustum.near, frustum.far) for shape in scene)
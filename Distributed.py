@@ -0,0 +1,194 @@
+##################
+# Distributed.py #
+##################
+# Spreads a render over as many hosts as you like.
+# A coordinator hands out tiles to whatever workers
+# connect to it, and collects their finished pixels.
+# Workers only ever receive the scene's settings, and
+# build the scene for themselves, which works because
+# a scene is entirely decided by its options and seed.
+#
+# Idle workers pull the next tile off the queue, and
+# once the queue runs dry they start duplicating tiles
+# that others are still working on, so one slow or hung
+# host can't hold up the end of the render. A tile whose
+# worker disconnects goes straight back on the queue.
+#
+# Connections are authenticated with a shared key, but
+# messages are pickled, so only use this on a network
+# you trust.
+
+from collections import deque
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+from optparse import Values
+from queue import Queue
+from threading import Thread, Condition
+from time import sleep
+import Scene
+import Profiler
+
+# How many workers may be on the same tile at once, counting the original
+MAX_COPIES = 2
+
+# How long closing waits for a worker still busy on a spare copy of a tile, in seconds
+GOODBYE_TIMEOUT = 10
+
+def parse_address(text, default_host="localhost"):
+    # Accepts either PORT or HOST:PORT
+    host, _, port = text.rpartition(':')
+    return (host or default_host, int(port))
+
+class Coordinator(object):
+    """Hands tiles out to connected workers and gathers up their results"""
+
+    def __init__(self, address, authkey, settings, verbose=False):
+        self._settings = settings
+        self._verbose = verbose
+        self._lock = Condition()
+        self._closed = False
+
+        # Every unfinished tile is a job: its camera and tile, and how many workers have it
+        self._jobs = {}
+        self._copies = {}
+        self._pending = deque()
+        self._next_job = 0
+        self._results = Queue()
+        self._threads = []
+
+        self._listener = Listener(address, authkey=authkey)
+        Thread(target=self._accept, daemon=True).start()
+
+        if verbose:
+            print("Waiting for workers on {}:{}".format(*self._listener.address))
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                # The listener was closed
+                return
+
+            if self._verbose:
+                print("Worker connected from {}".format(self._listener.last_accepted))
+            thread = Thread(target=self._serve, args=(connection,), daemon=True)
+            with self._lock:
+                self._threads.append(thread)
+            thread.start()
+
+    def _take(self):
+        # Blocks until there is a job for a worker, and gives back its number and what to send,
+        # or returns None once we're closed
+        with self._lock:
+            while not self._closed:
+                if self._pending:
+                    job = self._pending.popleft()
+                else:
+                    # Nothing left to hand out, so help with whichever tile has the fewest workers
+                    job = min(self._jobs, key=self._copies.get, default=None)
+                    if job is None or self._copies[job] >= MAX_COPIES:
+                        self._lock.wait()
+                        continue
+
+                self._copies[job] += 1
+                return job, self._jobs[job]
+            return None
+
+    def _release(self, job, result=None):
+        with self._lock:
+            # Only the first copy of a tile to finish counts
+            if job in self._jobs:
+                self._copies[job] -= 1
+                if result is not None:
+                    del self._jobs[job]
+                    del self._copies[job]
+                    self._results.put(result)
+                elif not self._copies[job]:
+                    # Nobody else is on it, so put it back at the front of the line
+                    self._pending.appendleft(job)
+            self._lock.notify_all()
+
+    def _serve(self, connection):
+        job = None
+        try:
+            connection.send(self._settings)
+            while True:
+                taken = self._take()
+                if taken is None:
+                    connection.send(None)
+                    break
+                job, payload = taken
+                connection.send(payload)
+                result = connection.recv()
+                self._release(job, result)
+                job = None
+        except (OSError, EOFError):
+            # The worker died, so its tile goes back to someone else
+            if job is not None:
+                self._release(job)
+        finally:
+            connection.close()
+
+    def render(self, camera, tiles):
+        # Queues up the tiles and yields each one's result as it comes in
+        with self._lock:
+            for tile in tiles:
+                self._jobs[self._next_job] = (camera, tile)
+                self._copies[self._next_job] = 0
+                self._pending.append(self._next_job)
+                self._next_job += 1
+            self._lock.notify_all()
+
+        for _ in tiles:
+            yield self._results.get()
+
+    def close(self):
+        # Tells every worker to go home, and waits until they've been told
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self._listener.close()
+
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            # A worker on a spare copy of the last tile hears once it hands that in, unless it hangs
+            thread.join(GOODBYE_TIMEOUT)
+
+def work(address, authkey, verbose=False, retries=30):
+    # Keep trying for a little while, in case the coordinator isn't up yet
+    for attempt in range(retries):
+        try:
+            connection = Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:
+            if attempt == retries - 1:
+                raise
+            sleep(1)
+
+    tiles = 0
+    try:
+        params = Values(connection.recv())
+        if params.profiling:
+            Profiler.enable()
+        scene, _ = Scene.build(params)
+        renderer = Scene.renderer(params)
+
+        while True:
+            job = connection.recv()
+            if job is None:
+                break
+            camera, tile = job
+            connection.send(renderer(scene, camera, tile))
+            tiles += 1
+    except (EOFError, OSError):
+        # The coordinator went away; there's nothing more to do
+        pass
+    finally:
+        connection.close()
+
+    if verbose:
+        print("Worker finished, rendered {} tiles".format(tiles))
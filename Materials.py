@@ -1,6 +1,5 @@
 from abc import ABCMeta, abstractmethod
 from Utility.Vector import *
-import random
 
 class Material(object):
     """Abstract Class to contain all the properties of how light interacts with a material"""
@@ -8,10 +7,16 @@ class Material(object):
     __metaclass__ = ABCMeta
 
     @abstractmethod
-    def scatter(self, incoming, intersect, refr_index):
-        # Must define how to scatter incoming rays
+    def scatter(self, incoming, intersect, refr_index, uniforms):
+        # Must define how to scatter incoming rays; any randomness comes
+        # from uniforms, a pair of numbers in [0, 1) drawn for this ray and bounce
         pass
 
+    def scatter_all(self, incoming, intersects, refr_index, uniforms):
+        # Scatters a whole batch of rays that hit this material, in order.
+        # Override this if a material has a faster way of doing it in bulk
+        return [self.scatter(ray, intersect, refr_index, draws) for ray, intersect, draws in zip(incoming, intersects, uniforms)]
+
 def schlick(cosine, eta):
     # The Schlick approximation of the Fresnel equation
     r0 = (1 - eta) / (1 + eta)
@@ -25,7 +30,7 @@ class Dielectric(Material):
         self.color = color
         self.refr_index = refr_index
 
-    def scatter(self, incoming, intersect, refr_index):
+    def scatter(self, incoming, intersect, refr_index, uniforms):
         entering = dot(incoming.direction, intersect.normal)
 
         # Are we entering or exiting the object?
@@ -41,22 +46,26 @@ class Dielectric(Material):
         reflected = reflect(incoming.direction, intersect.normal)
         refracted = refract(incoming.direction, outward_normal, eta)
 
+        # Reflections come back already normalized
         if refracted is None:
-            return self.color, Ray(intersect.point, reflected)
+            return self.color, Ray(intersect.point, reflected, True)
 
-        if random.uniform(0,1) < schlick(cosine, self.refr_index):
+        if uniforms[0] < schlick(cosine, self.refr_index):
             return self.color, Ray(intersect.point, refracted)
-        return self.color, Ray(intersect.point, reflected)
+        return self.color, Ray(intersect.point, reflected, True)
 
 class Lambertian(Material):
     """Matte, diffuse material"""
     def __init__(self, color):
         self.color = color
 
-    def scatter(self, incoming, intersect, refr_index):
-        target = intersect.point + intersect.normal + rand_unit_vector()
+    def scatter(self, incoming, intersect, refr_index, uniforms):
+        # Aim at a random point on the unit sphere touching the surface
+        px, py, pz = intersect.point
+        nx, ny, nz = intersect.normal
+        rx, ry, rz = rand_unit_vector(uniforms[0], uniforms[1])
 
-        return self.color, Ray(intersect.point, target - intersect.point)
+        return self.color, Ray(intersect.point, unit(px + nx + rx - px, py + ny + ry - py, pz + nz + rz - pz), True)
 
 class Metallic(Material):
     """Shiny, specular material"""
@@ -64,9 +73,11 @@ class Metallic(Material):
         self.color = color
         self.fuzz = fuzz
 
-    def scatter(self, incoming, intersect, refr_index):
-        reflected = reflect(incoming.direction, intersect.normal)
+    def scatter(self, incoming, intersect, refr_index, uniforms):
+        rx, ry, rz = reflect(incoming.direction, intersect.normal)
+        fx, fy, fz = rand_unit_vector(uniforms[0], uniforms[1])
+        fuzz = self.fuzz
 
-        bounce = Ray(intersect.point, reflected + rand_unit_vector() * self.fuzz)
+        bounce = Ray(intersect.point, unit(rx + fx * fuzz, ry + fy * fuzz, rz + fz * fuzz), True)
 
         return self.color, bounce if dot(bounce.direction, intersect.normal) > 0 else None
@@ -0,0 +1,321 @@
+###########
+# Mesh.py #
+###########
+# A triangle mesh, read from a Wavefront OBJ file, that
+# the scene sees as a single shape.
+#
+# Meshes run to millions of triangles, far too many to
+# make an object for each, so everything is kept in flat
+# arrays: the corners of the vertices, three vertex
+# numbers for each triangle, and a bounding volume
+# hierarchy of its own. The hierarchy is built by
+# sorting the triangles along a Morton curve, which
+# only takes one sort, and then the triangles are
+# stored in that order, so every leaf of the hierarchy
+# owns a run of neighbouring triangles.
+#
+# Triangles face whichever way they're wound counter
+# clockwise, as is usual for OBJ files.
+
+from array import array
+from bisect import bisect_left
+from itertools import chain, islice
+from operator import add
+import re
+import Profiler
+from Shapes import Shape, Intersection
+from Utility.Vector import Vector, unit
+
+# How many triangles a leaf of the hierarchy holds at most
+LEAF_SIZE = 8
+
+# Centroids are placed on a grid of this many cells along each axis, for their Morton codes
+GRID = 1024
+
+# Spreads the bits of a grid coordinate out two places apart, so three can be interleaved
+_SPREAD = [sum(((cell >> bit) & 1) << (3 * bit) for bit in range(10)) for cell in range(GRID)]
+
+# How many lines of a file are read at once
+CHUNK = 65536
+
+# The texture and normal numbers of a face's corner, which are skipped
+_CORNER = re.compile(r"/[^ \t\n]*")
+
+# Hits closer than this to parallel with a triangle are ignored
+EPSILON = 1e-12
+
+def _fan(corners, size):
+    # The triangles of faces that all have the same number of corners, counting from 1,
+    # each split into a fan around its first corner
+    faces = len(corners) // size
+    triangles = array('i', bytes(3 * (size - 2) * faces * corners.itemsize))
+    for index in range(size - 2):
+        for offset, corner in enumerate((0, index + 1, index + 2)):
+            triangles[3 * index + offset::3 * (size - 2)] = corners[corner::size]
+    return array('i', map((-1).__add__, triangles))
+
+def _faces(lines, count):
+    # The triangles of the faces among lines, a line at a time, where count vertices came before
+    triangles = array('i')
+    for line in lines:
+        if line.startswith("v "):
+            count += 1
+        if not line.startswith("f "):
+            continue
+        # Each corner is vertex/texture/normal, counting from 1, or back from the latest vertex if negative
+        corners = [int(corner.split('/')[0]) for corner in line.split()[1:]]
+        corners = [corner - 1 if corner > 0 else count + corner for corner in corners]
+        if len(corners) < 3 or not all(0 <= corner < count for corner in corners):
+            raise ValueError("bad face '{}'".format(line.strip()))
+        for second, third in zip(corners[1:], corners[2:]):
+            triangles.extend((corners[0], second, third))
+    return triangles
+
+def _read(chunk, vertices, triangles):
+    # Adds the vertices and triangles in a chunk of lines. Usually every vertex is three
+    # numbers and every face has no negative corners, and the whole chunk can be read in
+    # one go; anything else is read a line at a time
+    count = len(vertices) // 3
+    points = [line[2:] for line in chunk if line.startswith("v ")]
+    numbers = " ".join(points).split()
+    if len(numbers) == 3 * len(points):
+        vertices.extend(map(float, numbers))
+    else:
+        for point in points:
+            vertices.extend(map(float, point.split()[:3]))
+
+    # The order of the triangles doesn't matter, so faces are read in bunches with the same number of corners
+    faces = list(map(str.split, _CORNER.sub("", "".join(line[1:] for line in chunk if line.startswith("f "))).splitlines()))
+    sizes = list(map(len, faces))
+    bunches = {size: array('i', map(int, chain.from_iterable(face for face, length in zip(faces, sizes) if length == size)))
+               for size in set(sizes)}
+    if min(bunches, default=3) >= 3 and all(not corners or min(corners) > 0 for corners in bunches.values()):
+        for size, corners in bunches.items():
+            triangles.extend(_fan(corners, size))
+    else:
+        triangles.extend(_faces(chunk, count))
+
+def read_obj(path):
+    # The vertices and triangles of an OBJ file, as flat arrays. Faces with more
+    # than three corners are split into a fan of triangles, and everything other
+    # than vertices and faces (normals, texture coordinates, groups) is skipped
+    vertices = array('d')
+    triangles = array('i')
+
+    with open(path) as file:
+        for chunk in iter(lambda: list(islice(file, CHUNK)), []):
+            try:
+                _read(chunk, vertices, triangles)
+            except ValueError as error:
+                raise ValueError("{}: {}".format(path, error))
+
+    if triangles and (min(triangles) < 0 or max(triangles) >= len(vertices) // 3):
+        raise ValueError("{}: a face refers to a vertex that isn't there".format(path))
+    return vertices, triangles
+
+class Mesh(Shape):
+    """A triangle mesh kept in packed arrays, with its own hierarchy of bounding boxes"""
+
+    def __init__(self, material, path, position=(0, 0, 0), scale=1.0):
+        self._material = material
+        vertices, triangles = read_obj(path)
+        if not triangles:
+            raise ValueError("'{}' has no faces".format(path))
+
+        # Scale about the origin of the file, then move it into place
+        for axis, offset in enumerate(position):
+            vertices[axis::3] = array('d', map(float(offset).__add__, map(float(scale).__mul__, vertices[axis::3])))
+        self._vertices = vertices
+
+        # Each node is six bounds, lower then upper, in _bounds and two links in _links: a leaf's
+        # first triangle and how many it has, or an inner node's right child and 0. An inner
+        # node's left child is the next node over
+        self._triangles = self._build(triangles)
+
+        # The ray and distance of the last hit, and which triangle it was
+        self._hit = None
+
+    #MARK: Building
+
+    def _build(self, triangles):
+        # Sorts the triangles along a Morton curve through their centroids, then splits the
+        # sorted run wherever the codes first differ, and returns the triangles in their new
+        # order. Everything done per triangle is a map or a comprehension, to keep big meshes quick
+        count = len(triangles) // 3
+        corners = [triangles[0::3], triangles[1::3], triangles[2::3]]
+
+        # For each axis, the lowest and highest coordinate of every triangle, and the spread
+        # out number of the cell its centroid is in
+        lows, highs, cells = [], [], []
+        for axis in range(3):
+            coordinates = self._vertices[axis::3]
+            a, b, c = (array('d', map(coordinates.__getitem__, corner)) for corner in corners)
+            lows.append(array('d', map(min, a, b, c)))
+            highs.append(array('d', map(max, a, b, c)))
+            lower, upper = min(lows[axis]), max(highs[axis])
+            scale = (GRID - 1) / (3 * (upper - lower)) if upper > lower else 0.0
+            sums = map((-3 * lower).__add__, map(add, map(add, a, b), c))
+            cells.append(array('q', map(_SPREAD.__getitem__, map(int, map(scale.__mul__, sums)))))
+
+        # Interleave the bits of the three cells into one code, and sort by it
+        codes = array('q', map(add, map(add, map((4).__mul__, cells[0]), map((2).__mul__, cells[1])), cells[2]))
+        order = sorted(range(count), key=codes.__getitem__)
+        codes = array('q', map(codes.__getitem__, order))
+        lows = [array('d', map(low.__getitem__, order)) for low in lows]
+        highs = [array('d', map(high.__getitem__, order)) for high in highs]
+
+        self._links = self._split(codes)
+        self._bounds = self._boxes(self._links, lows, highs)
+
+        ordered = array('i', bytes(len(triangles) * triangles.itemsize))
+        for offset, corner in enumerate(corners):
+            ordered[offset::3] = array('i', map(corner.__getitem__, order))
+        return ordered
+
+    def _split(self, codes):
+        # Lays out the tree over the sorted triangles, returning the links of its nodes.
+        # Parents come before their children, and a node starts out as a leaf until
+        # its right child turns up
+        links = array('i')
+        stack = [(0, len(codes), None)]
+
+        while stack:
+            first, last, parent = stack.pop()
+            node = len(links) // 2
+            if parent is not None:
+                links[2 * parent:2 * parent + 2] = array('i', (node, 0))
+            links.extend((first, last - first))
+
+            if last - first <= LEAF_SIZE:
+                continue
+
+            if codes[first] == codes[last - 1]:
+                # Everything is in the same cell, so just halve it
+                middle = (first + last) // 2
+            else:
+                # Split where the highest bit that differs turns on
+                bit = (codes[first] ^ codes[last - 1]).bit_length() - 1
+                middle = bisect_left(codes, codes[last - 1] >> bit << bit, first, last)
+
+            # The left child comes straight after its parent, the right one once the left is done
+            stack.append((middle, last, node))
+            stack.append((first, middle, None))
+
+        return links
+
+    def _boxes(self, links, lows, highs):
+        # The bounds of every node. Children always come after their parents,
+        # so going backwards each node's children are done before it is
+        boxes = array('d', bytes(3 * len(links) * 8))
+        for node in range(len(links) // 2 - 1, -1, -1):
+            start, count = links[2 * node], links[2 * node + 1]
+            if count:
+                box = [min(low[start:start + count]) for low in lows] + [max(high[start:start + count]) for high in highs]
+            else:
+                left, right = boxes[6 * node + 6:6 * node + 12], boxes[6 * start:6 * start + 6]
+                box = list(map(min, left[:3], right[:3])) + list(map(max, left[3:], right[3:]))
+            boxes[6 * node:6 * node + 6] = array('d', box)
+        return boxes
+
+    #MARK: Intersecting
+
+    def bounds(self):
+        return Vector._make(self._bounds[0:3]), Vector._make(self._bounds[3:6])
+
+    def intersect_distance(self, ray, near, far):
+        ox, oy, oz = ray.origin
+        dx, dy, dz = ray.direction
+        ix = 1.0 / dx if dx else float('inf')
+        iy = 1.0 / dy if dy else float('inf')
+        iz = 1.0 / dz if dz else float('inf')
+
+        bounds, links, vertices, triangles = self._bounds, self._links, self._vertices, self._triangles
+        hit = None
+        tested = 0
+        stack = [0]
+
+        while stack:
+            node = stack.pop()
+
+            # Clip [near, far] against the node's box, one axis at a time
+            lx, ly, lz, ux, uy, uz = bounds[6 * node:6 * node + 6]
+            t1, t2 = (lx - ox) * ix, (ux - ox) * ix
+            low, high = (t1, t2) if t1 < t2 else (t2, t1)
+            t1, t2 = (ly - oy) * iy, (uy - oy) * iy
+            low, high = max(low, min(t1, t2)), min(high, max(t1, t2))
+            t1, t2 = (lz - oz) * iz, (uz - oz) * iz
+            low, high = max(low, min(t1, t2), near), min(high, max(t1, t2), far)
+            if low > high:
+                continue
+
+            start, count = links[2 * node], links[2 * node + 1]
+            if not count:
+                stack.append(start)
+                stack.append(node + 1)
+                continue
+
+            tested += count
+            for triangle in range(start, start + count):
+                # Möller-Trumbore: solve for where the ray crosses the triangle's plane, in barycentric coordinates
+                a, b, c = triangles[3 * triangle:3 * triangle + 3]
+                ax, ay, az = vertices[3 * a:3 * a + 3]
+                bx, by, bz = vertices[3 * b:3 * b + 3]
+                cx, cy, cz = vertices[3 * c:3 * c + 3]
+                e1x, e1y, e1z = bx - ax, by - ay, bz - az
+                e2x, e2y, e2z = cx - ax, cy - ay, cz - az
+
+                px, py, pz = dy * e2z - dz * e2y, dz * e2x - dx * e2z, dx * e2y - dy * e2x
+                determinant = e1x * px + e1y * py + e1z * pz
+                if -EPSILON < determinant < EPSILON:
+                    continue
+                inverse = 1.0 / determinant
+
+                sx, sy, sz = ox - ax, oy - ay, oz - az
+                u = (sx * px + sy * py + sz * pz) * inverse
+                if u < 0.0 or u > 1.0:
+                    continue
+
+                qx, qy, qz = sy * e1z - sz * e1y, sz * e1x - sx * e1z, sx * e1y - sy * e1x
+                v = (dx * qx + dy * qy + dz * qz) * inverse
+                if v < 0.0 or u + v > 1.0:
+                    continue
+
+                distance = (e2x * qx + e2y * qy + e2z * qz) * inverse
+                if near <= distance <= far:
+                    far = distance
+                    hit = triangle
+
+        Profiler.count("tests per shape", "Triangle", tested)
+
+        if hit is None:
+            return None
+        # Remember which triangle it was, for when the hit's normal is needed
+        self._hit = (ray, far, hit)
+        return far
+
+    def intersection(self, ray, distance):
+        if self._hit is None or self._hit[0] is not ray or self._hit[1] != distance:
+            # The last hit was for some other ray, so find the triangle again
+            self.intersect_distance(ray, distance, distance)
+        triangle = self._hit[2]
+
+        a, b, c = self._triangles[3 * triangle:3 * triangle + 3]
+        ax, ay, az = self._vertices[3 * a:3 * a + 3]
+        bx, by, bz = self._vertices[3 * b:3 * b + 3]
+        cx, cy, cz = self._vertices[3 * c:3 * c + 3]
+        e1x, e1y, e1z = bx - ax, by - ay, bz - az
+        e2x, e2y, e2z = cx - ax, cy - ay, cz - az
+        normal = unit(e1y * e2z - e1z * e2y, e1z * e2x - e1x * e2z, e1x * e2y - e1y * e2x)
+
+        return Intersection(distance, ray.project(distance), normal, self._material)
+
+    #MARK: Pickling
+
+    def __getstate__(self):
+        # The last hit is only a shortcut, and has nothing to do with what the mesh is
+        state = dict(vars(self))
+        state["_hit"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
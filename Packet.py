@@ -0,0 +1,427 @@
+#############
+# Packet.py #
+#############
+# A second engine that traces whole packets of rays
+# at once using NumPy. Rather than building a Ray per
+# sample, every ray in a tile is kept in (N,3) arrays
+# of origins and directions, each shape is intersected
+# against the entire packet in one expression, and the
+# nearest hit is picked out with argmin.
+#
+# The math here mirrors Shapes.py and Materials.py
+# closely, so a scene renders to a statistically
+# equivalent image with either engine.
+
+from time import time
+import numpy as np
+import Shapes
+import Materials
+import Camera
+import BVH
+import Mesh
+import Profiler
+import Utility.Color as Color
+from Utility.Framebuffer import GUIDES
+import Utility.Streams as Streams
+import Sampler
+
+#MARK: Packet math
+
+def _unit(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1)[:, None]
+
+def _dot(lhs, rhs):
+    # Row-wise dot-product
+    return np.einsum('ij,ij->i', lhs, rhs)
+
+def _rand_unit_vectors(u, v):
+    z = 2 * u - 1
+    r = np.sqrt(1 - z * z)
+    phi = 2 * np.pi * v
+    return np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=1)
+
+def _reflect(directions, normals):
+    return _unit(directions - normals * (2 * _dot(directions, normals))[:, None])
+
+def _sky_gradient(angles):
+    interpolate = (0.5 * (angles + 1))[:, None]
+    return np.array(Color.white) * (1 - interpolate) + np.array([0.5, 0.7, 1.0]) * interpolate
+
+#MARK: Random streams
+
+def _mix(z):
+    # The same hash as Streams, on arrays of uint64 that wrap around just like the masked ints
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(Streams.MIX1)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(Streams.MIX2)
+    return z ^ (z >> np.uint64(31))
+
+def _keys(seed, xs, ys, samples):
+    # The (pixel, sample, stream) keys of many samples, as three arrays, matching Streams.pixel and Streams.stream
+    seed = np.uint64(Streams._mix(seed & Streams.MASK))
+    pixels = _mix(_mix(seed ^ xs.astype(np.uint64)) ^ ys.astype(np.uint64))
+    samples = samples.astype(np.uint64)
+    return pixels, samples, _mix(pixels ^ samples)
+
+def _uniforms(keys, bounce):
+    # An (N,2) array of each stream's pair of numbers for the bounce, matching Streams.uniforms
+    z = _mix(keys + np.uint64(((bounce + 1) * Streams.GAMMA) & Streams.MASK))
+    return np.stack((z >> np.uint64(32), z & np.uint64(Streams.HALF)), axis=1) * Streams.SCALE
+
+def _decisions(keys, bounce):
+    # An array of each stream's number for decisions at the bounce, matching Streams.decisions
+    z = _mix((keys ^ np.uint64(Streams.DECISIONS)) + np.uint64(((bounce + 1) * Streams.GAMMA) & Streams.MASK))
+    return (z >> np.uint64(32)) * Streams.SCALE
+
+def _pairs(sampler, keys, rays, bounce):
+    # An (N,2) array of the numbers the given rays draw for the bounce. Only plain
+    # random numbers are worked out here; other samplers get the keys as ints
+    pixels, samples, streams = keys
+    if isinstance(sampler, Sampler.Independent):
+        return _uniforms(streams[rays], bounce)
+    keys = zip(pixels[rays].tolist(), samples[rays].tolist(), streams[rays].tolist())
+    return np.array(sampler.pairs(list(keys), bounce)).reshape(len(rays), 2)
+
+#MARK: Shapes
+
+def _intersect(shape, origins, directions, frustum):
+    # Distance to each ray's intersection with shape, or inf if it misses
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if isinstance(shape, Shapes.Plane):
+            normal = np.array(shape._normal)
+            distances = (shape._n_dot_p - origins @ normal) / (directions @ normal)
+            return np.where((frustum.near <= distances) & (distances <= frustum.far), distances, np.inf)
+
+        A, B, C, D, E, F, G, H, I, J = shape._equation
+        x, y, z = (origins - np.array(shape._position)).T
+        u, v, w = directions.T
+
+        # The quadratic coefficients of Ax² + By² + Cz² + 2Dyz + 2Exz + 2Fxy + 2Gx + 2Hy + 2Iz + J
+        # along every ray at once
+        a = A*u*u + B*v*v + C*w*w + 2*(D*v*w + E*u*w + F*u*v)
+        b = (A*x*u + B*y*v + C*z*w
+             + D*(y*w + v*z) + E*(x*w + u*z) + F*(x*v + u*y)
+             + G*u + H*v + I*w)
+        c = A*x*x + B*y*y + C*z*z + 2*(D*y*z + E*x*z + F*x*y) + 2*(G*x + H*y + I*z) + J
+
+        # Imaginary roots come out as nan, which fail every comparison below
+        root = np.sqrt(b*b - a*c)
+        near = (-b - root) / a
+        far = (-b + root) / a
+
+    return np.where((frustum.near <= near) & (near <= frustum.far), near,
+                    np.where((frustum.near <= far) & (far <= frustum.far), far, np.inf))
+
+def _triangles(mesh, start, count, origins, directions, frustum):
+    # Distance to each ray's nearest hit among a run of the mesh's triangles, or inf
+    # if it misses them all, and which of them it hit. Möller-Trumbore, as in Mesh.py
+    vertices = np.frombuffer(mesh._vertices).reshape(-1, 3)
+    corners = vertices[np.frombuffer(mesh._triangles, dtype=np.intc)[3 * start:3 * (start + count)].reshape(-1, 3)]
+    a, e1, e2 = corners[:, 0], corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+
+    # Every ray against every triangle, as (rays, triangles, 3)
+    d = directions[:, None, :]
+    p = np.cross(d, e2)
+    determinant = np.sum(e1 * p, axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = 1.0 / determinant
+        s = origins[:, None, :] - a
+        u = np.sum(s * p, axis=2) * inverse
+        q = np.cross(s, e1)
+        v = np.sum(d * q, axis=2) * inverse
+        distances = np.sum(e2 * q, axis=2) * inverse
+
+    hit = ((np.abs(determinant) >= Mesh.EPSILON) & (u >= 0.0) & (u <= 1.0) & (v >= 0.0) & (u + v <= 1.0)
+           & (frustum.near <= distances) & (distances <= frustum.far))
+    distances = np.where(hit, distances, np.inf)
+    which = np.argmin(distances, axis=1)
+    return distances[np.arange(len(origins)), which], which
+
+def _intersect_mesh(mesh, origins, directions, frustum):
+    # Distance to each ray's intersection with the mesh, or inf if it misses, and which
+    # triangle it hit. The rays walk down the mesh's own hierarchy like in _traverse
+    bounds = np.frombuffer(mesh._bounds).reshape(-1, 2, 3)
+    links = mesh._links
+    distance = np.full(len(origins), np.inf)
+    faces = np.full(len(origins), -1)
+    with np.errstate(divide='ignore'):
+        inverses = 1.0 / directions
+    stack = [(0, np.arange(len(origins)))]
+
+    while stack:
+        node, rays = stack.pop()
+
+        with np.errstate(invalid='ignore'):
+            t1 = (bounds[node, 0] - origins[rays]) * inverses[rays]
+            t2 = (bounds[node, 1] - origins[rays]) * inverses[rays]
+        near = np.maximum(np.minimum(t1, t2).max(axis=1), frustum.near)
+        far = np.minimum(np.maximum(t1, t2).min(axis=1), distance[rays])
+        rays = rays[near <= np.minimum(far, frustum.far)]
+
+        if not len(rays):
+            continue
+
+        start, count = links[2 * node], links[2 * node + 1]
+        if count:
+            distances, which = _triangles(mesh, start, count, origins[rays], directions[rays], frustum)
+            Profiler.count("tests per shape", "Triangle", len(rays) * count)
+            closer = distances < distance[rays]
+            distance[rays[closer]] = distances[closer]
+            faces[rays[closer]] = start + which[closer]
+        else:
+            stack.append((start, rays))
+            stack.append((node + 1, rays))
+
+    return distance, faces
+
+def _normals(shape, points, faces):
+    if isinstance(shape, Mesh.Mesh):
+        vertices = np.frombuffer(shape._vertices).reshape(-1, 3)
+        corners = vertices[np.frombuffer(shape._triangles, dtype=np.intc).reshape(-1, 3)[faces]]
+        return _unit(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]))
+
+    if isinstance(shape, Shapes.Plane):
+        return np.broadcast_to(np.array(shape._normal), points.shape)
+
+    relative = points - np.array(shape._position)
+    if isinstance(shape, Shapes.Sphere):
+        return _unit(relative)
+
+    A, B, C, D, E, F, G, H, I, J = shape._equation
+    x, y, z = relative.T
+    return _unit(np.stack((2*A*x + E*z + F*y + G,
+                           2*B*y + D*z + F*x + H,
+                           2*C*z + D*y + E*x + I), axis=1))
+
+#MARK: Materials
+
+def _scatter(material, directions, normals, refr_index, uniforms):
+    # Returns the bounce directions, and which of them survived
+    count = len(directions)
+
+    if isinstance(material, Materials.Lambertian):
+        return _unit(normals + _rand_unit_vectors(uniforms[:, 0], uniforms[:, 1])), np.ones(count, dtype=bool)
+
+    if isinstance(material, Materials.Metallic):
+        bounces = _unit(_reflect(directions, normals) + _rand_unit_vectors(uniforms[:, 0], uniforms[:, 1]) * material.fuzz)
+        return bounces, _dot(bounces, normals) > 0
+
+    if isinstance(material, Materials.Dielectric):
+        entering = _dot(directions, normals)
+        inside = entering < 0
+
+        outward_normals = np.where(inside[:, None], -normals, normals)
+        eta = np.where(inside, material.refr_index / refr_index, refr_index / material.refr_index)
+        cosine = np.where(inside, material.refr_index * entering, -entering)
+
+        reflected = _reflect(directions, normals)
+
+        dt = _dot(directions, outward_normals)
+        discriminant = 1.0 - (eta ** 2) * (1.0 - dt ** 2)
+        refracted = ((directions - outward_normals * dt[:, None]) * eta[:, None]
+                     - outward_normals * np.sqrt(np.maximum(discriminant, 0))[:, None])
+
+        choose = (discriminant > 0) & (uniforms[:, 0] < Materials.schlick(cosine, material.refr_index))
+        return _unit(np.where(choose[:, None], refracted, reflected)), np.ones(count, dtype=bool)
+
+    raise TypeError("No packet scatter for material {}".format(type(material).__name__))
+
+#MARK: Tracing
+
+def _primitives(scene):
+    # Every shape in the scene, with any hierarchies flattened out into their shapes
+    shapes = []
+    for shape in scene:
+        shapes.extend(shape.unpacked() if isinstance(shape, BVH.BVH) else [shape])
+    return shapes
+
+def _nearer(shape, index, rays, origins, directions, frustum, distance, nearest, faces):
+    # Intersects the given rays with a shape, and keeps any hits closer than what they had,
+    # along with which triangle they hit if the shape is a mesh
+    if isinstance(shape, Mesh.Mesh):
+        distances, found = _intersect_mesh(shape, origins[rays], directions[rays], frustum)
+    else:
+        distances, found = _intersect(shape, origins[rays], directions[rays], frustum), None
+    Profiler.count("tests per shape", type(shape).__name__, len(rays))
+    closer = distances < distance[rays]
+    distance[rays[closer]] = distances[closer]
+    nearest[rays[closer]] = index
+    if found is not None:
+        faces[rays[closer]] = found[closer]
+
+def _traverse(bvh, offset, rays, origins, directions, inverses, frustum, distance, nearest, faces):
+    # Walks the packet down the hierarchy, dropping rays from each branch whose box they miss
+    stack = [(0, rays)]
+
+    while stack:
+        node, rays = stack.pop()
+        lower, upper, start, end, right = bvh.nodes[node]
+
+        with np.errstate(invalid='ignore'):
+            t1 = (np.array(lower) - origins[rays]) * inverses[rays]
+            t2 = (np.array(upper) - origins[rays]) * inverses[rays]
+        near = np.maximum(np.minimum(t1, t2).max(axis=1), frustum.near)
+        far = np.minimum(np.maximum(t1, t2).min(axis=1), distance[rays])
+        rays = rays[near <= np.minimum(far, frustum.far)]
+
+        if not len(rays):
+            continue
+
+        if right is None:
+            for index in range(start, end):
+                _nearer(bvh.shapes[index], offset + index, rays, origins, directions, frustum, distance, nearest, faces)
+        else:
+            stack.append((right, rays))
+            stack.append((node + 1, rays))
+
+def _closest(scene, origins, directions, frustum):
+    # The distance to each ray's nearest hit, the index of the primitive it hit (-1 if none)
+    # and, for rays that hit a mesh, which of its triangles
+    distance = np.full(len(origins), np.inf)
+    nearest = np.full(len(origins), -1)
+    faces = np.full(len(origins), -1)
+    rays = np.arange(len(origins))
+
+    offset = 0
+    for shape in scene:
+        if isinstance(shape, BVH.BVH):
+            with np.errstate(divide='ignore'):
+                inverses = 1.0 / directions
+            _traverse(shape, offset, rays, origins, directions, inverses, frustum, distance, nearest, faces)
+            offset += len(shape.shapes)
+        else:
+            _nearer(shape, offset, rays, origins, directions, frustum, distance, nearest, faces)
+            offset += 1
+
+    return distance, nearest, faces
+
+def _survivors(throughput, keys, alive, survived, bounce, roulette, cutoff):
+    # Narrows survived down to the rays that carry on, brightening any that survive Russian roulette
+    strongest = throughput[alive].max(axis=1)
+
+    if cutoff:
+        faded = survived & (strongest < cutoff)
+        Profiler.count("paths ended", "cutoff", int(np.count_nonzero(faded)))
+        survived = survived & ~faded
+
+    if roulette is not None and bounce >= roulette:
+        playing = survived & (strongest < 1.0)
+        unlucky = playing & (_decisions(keys[2][alive], bounce) >= strongest)
+        Profiler.count("paths ended", "roulette", int(np.count_nonzero(unlucky)))
+        survived = survived & ~unlucky
+        winners = playing & ~unlucky
+        throughput[alive[winners]] /= strongest[winners][:, None]
+
+    return survived
+
+def trace(scene, origins, directions, sampler, keys, depth, frustum, roulette=None, cutoff=None, guides=None):
+    # Iteratively bounces a packet of rays, returning each ray's color and how many times it was cast.
+    # Each ray draws its random numbers from the sampler, with the keys of the same index.
+    # Faded paths are ended early just like in Camera.terminate.
+    # If guides is given, an (N,7) array, it's filled in with the guides of what each ray hits first
+    shapes = _primitives(scene)
+    colors = np.zeros(origins.shape)
+    throughput = np.ones(origins.shape)
+    casts = np.zeros(len(origins), dtype=int)
+    alive = np.arange(len(origins))
+    profile = Profiler.current
+
+    for generation in range(depth):
+        if not len(alive):
+            break
+        casts[alive] += 1
+        begin = time()
+
+        distance, nearest, faces = _closest(scene, origins, directions, frustum)
+        draws = _pairs(sampler, keys, alive, generation + 1)
+        middle = time()
+
+        # Rays that shoot into space pick up the sky
+        missed = nearest < 0
+        colors[alive[missed]] = throughput[alive[missed]] * _sky_gradient(directions[missed, 2])
+
+        first = guides is not None and generation == 0
+        if first:
+            guides[alive[missed], :3] = _sky_gradient(directions[missed, 2])
+            guides[alive[missed], 6] = frustum.far
+
+        points = origins + directions * np.where(missed, 0, distance)[:, None]
+        bounces = np.empty(directions.shape)
+        survived = np.zeros(len(alive), dtype=bool)
+
+        # Scatter the rays that hit something, grouped by the shape they hit
+        hit = np.flatnonzero(~missed)
+        order = hit[np.argsort(nearest[hit], kind='stable')]
+        groups, starts = np.unique(nearest[order], return_index=True)
+
+        for index, hits in zip(groups, np.split(order, starts[1:])):
+            shape = shapes[index]
+            normals = _normals(shape, points[hits], faces[hits])
+            bounces[hits], survived[hits] = _scatter(shape._material, directions[hits], normals, Camera.scene_refraction_index, draws[hits])
+            throughput[alive[hits]] *= np.array(shape._material.color)
+            if first:
+                guides[alive[hits], :3] = shape._material.color
+                guides[alive[hits], 3:6] = normals
+                guides[alive[hits], 6] = distance[hits]
+            if profile:
+                profile.count("hits per material", type(shape._material).__name__, len(hits))
+
+        if profile:
+            profile.count("rays per depth", generation, len(alive))
+            profile.span("intersect", begin, middle, depth=generation)
+            profile.span("scatter", middle, time(), depth=generation)
+
+        if cutoff or (roulette is not None and generation + 1 >= roulette):
+            survived = _survivors(throughput, keys, alive, survived, generation + 1, roulette, cutoff)
+
+        alive = alive[survived]
+        origins = points[survived]
+        directions = bounces[survived]
+
+    # Anything still bouncing when we run out of depth stays black
+    return colors, casts
+
+def render_tile(scene, camera, tile):
+    previous = Profiler.begin()
+    begin = time()
+
+    # One ray per sample per pixel, with the samples of a pixel next to each other
+    ys, xs = np.mgrid[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width]
+    xs = np.repeat(xs.ravel(), camera.samples)
+    ys = np.repeat(ys.ravel(), camera.samples)
+    samples = np.tile(np.arange(camera.first_sample, camera.first_sample + camera.samples), tile.width * tile.height)
+    keys = _keys(camera.seed, xs, ys, samples)
+
+    # The first pair of numbers a sample draws place it within its pixel
+    offsets = _pairs(camera.sampler, keys, np.arange(len(xs)), 0)
+    xs = xs + offsets[:, 0]
+    ys = ys + offsets[:, 1]
+
+    screen_coordinates = (np.array(camera.origin)
+                          + np.outer(xs, camera.i_hat)
+                          - np.outer(ys, camera.j_hat))
+    directions = _unit(screen_coordinates)
+    origins = np.broadcast_to(np.array(camera.position, dtype=float), directions.shape)
+
+    guides = np.zeros((len(directions), len(GUIDES))) if camera.guides else None
+    colors, casts = trace(scene, origins, directions, camera.sampler, keys, camera.depth, camera.frustum,
+                          camera.roulette, camera.cutoff, guides)
+
+    pixels = colors.reshape(tile.height, tile.width, camera.samples, 3).mean(axis=2)
+    casts = casts.reshape(tile.height, tile.width, camera.samples).sum(axis=2)
+    if guides is not None:
+        guides = guides.reshape(tile.height, tile.width, camera.samples, len(GUIDES)).mean(axis=2).tolist()
+
+    # Pixels aren't timed individually, so share the tile's time out by how many rays each cast
+    elapsed = time() - begin
+    times = casts * (elapsed / max(casts.sum(), 1))
+
+    if Profiler.current:
+        Profiler.current.span("tile", begin, begin + elapsed, x=tile.x, y=tile.y)
+
+    return Camera.TileResult(tile,
+                             [[Color.Color._make(pixel) for pixel in row] for row in pixels.tolist()],
+                             times.tolist(),
+                             [[camera.samples] * tile.width for _ in range(tile.height)],
+                             int(casts.sum()),
+                             Profiler.end(previous),
+                             guides)
@@ -0,0 +1,86 @@
+###############
+# Parallel.py #
+###############
+# Farms tiles of the image out to a pool of worker
+# processes. Each worker receives its own copy of the
+# scene exactly once, when it starts up; after that
+# only tile rectangles and finished pixels cross the
+# process boundary.
+#
+# A pool can be kept around for as many renders of the
+# same scene as you like, like the frames of an
+# animation, so the workers only start up once.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Utility.Framebuffer import Framebuffer
+import Profiler
+
+# Each worker process keeps its copy of the scene here, along with the
+# shared framebuffer it's writing into, if it was given one
+_scene = None
+_framebuffer = None
+
+def _install(scene, profiling):
+    global _scene
+    _scene = scene
+    if profiling:
+        Profiler.enable()
+
+def _attach(name, path, width, height, guides):
+    # Opens the framebuffer the tiles go into, unless it's the one that's already open
+    global _framebuffer
+    if _framebuffer is not None:
+        if (_framebuffer.name, _framebuffer.path) == (name, path):
+            return
+        # It belongs to the process that made it, so leave it for that process to unlink
+        _framebuffer.close(unlink=False)
+        _framebuffer = None
+
+    if path:
+        _framebuffer = Framebuffer.open(path)
+    elif name:
+        _framebuffer = Framebuffer(width, height, name=name, guides=guides)
+
+def _render(renderer, camera, tile, target):
+    _attach(*target)
+    result = renderer(_scene, camera, tile)
+    if _framebuffer is None:
+        return result
+
+    # Write the pixels straight into the shared or mapped framebuffer, and only send back the tally
+    _framebuffer.add(result)
+    return result._replace(pixels=None, times=None, samples=None, guides=None)
+
+class Pool(object):
+    """Worker processes that each hold a copy of the scene, for as many renders as it's needed"""
+
+    def __init__(self, scene, workers):
+        self._executor = ProcessPoolExecutor(workers, initializer=_install, initargs=(scene, Profiler.enabled()))
+
+    def render(self, renderer, camera, tiles, framebuffer=None):
+        # Yields finished tiles as soon as they are done, in no particular order.
+        # Tiles never overlap, so workers can safely share the framebuffer
+        target = ((framebuffer.name, framebuffer.path, camera.width, camera.height, bool(framebuffer.guides))
+                  if framebuffer is not None else (None, None, 0, 0, False))
+        futures = [self._executor.submit(_render, renderer, camera, tile, target) for tile in tiles]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # If the render is abandoned partway, the tiles that haven't started needn't be
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+def render(renderer, scene, camera, tiles, workers, framebuffer=None):
+    # Renders with a pool of its own, that's shut down once every tile is done
+    with Pool(scene, workers) as pool:
+        yield from pool.render(renderer, camera, tiles, framebuffer)
@@ -0,0 +1,155 @@
+###############
+# Profiler.py #
+###############
+# Counts and times what the renderer gets up to:
+# how many rays are cast at each bounce, how many
+# intersection tests each kind of shape takes, how
+# many hits each kind of material gets, and how long
+# each stage of a render runs for.
+#
+# Profiling is off unless enable() is called, and
+# while it's off, current is None and nothing is
+# counted; the shapes aren't even wrapped for counting
+# until then, so a normal render pays next to nothing.
+#
+# Every tile is profiled on its own and the result
+# travels back with it, so the numbers add up the
+# same whether tiles were rendered here, in a pool
+# or on another machine.
+
+from collections import Counter
+from contextlib import contextmanager
+from statistics import mean, median
+from time import time
+import json
+import os
+import Shapes
+
+# The profile being collected in this process, or None if profiling is off
+current = None
+
+class Profile(object):
+    """Counters and timed spans collected while rendering"""
+
+    def __init__(self):
+        self.counters = {}
+        # Total seconds and number of spans for each stage
+        self.stages = Counter()
+        self.spans = Counter()
+        # Chrome trace events, one for each span
+        self.events = []
+        self.details = {}
+
+    def count(self, group, key, amount=1):
+        self.counters.setdefault(group, Counter())[key] += amount
+
+    def span(self, name, begin, end, **args):
+        self.stages[name] += end - begin
+        self.spans[name] += 1
+        # Timestamps are wall clock microseconds, so spans from different processes line up
+        self.events.append({"name": name, "ph": "X", "ts": begin * 1e6, "dur": (end - begin) * 1e6,
+                            "pid": os.getpid(), "tid": 0, "args": args})
+
+    def merge(self, other):
+        for group, counter in other.counters.items():
+            self.counters.setdefault(group, Counter()).update(counter)
+        self.stages.update(other.stages)
+        self.spans.update(other.spans)
+        self.events.extend(other.events)
+        self.details.update(other.details)
+
+    def report(self):
+        report = {"stages": {name: {"seconds": seconds, "count": self.spans[name]}
+                             for name, seconds in self.stages.items()}}
+        for group, counter in self.counters.items():
+            report[group] = {str(key): value for key, value in sorted(counter.items())}
+        report.update(self.details)
+        return report
+
+    def chrome_trace(self):
+        # The Trace Event Format, which chrome://tracing, Perfetto and speedscope can all open
+        return {"traceEvents": sorted(self.events, key=lambda event: event["ts"]),
+                "displayTimeUnit": "ms"}
+
+#MARK: Switching on
+
+def _counting(method, name):
+    def intersect_distance(self, ray, near, far):
+        current.count("tests per shape", name)
+        return method(self, ray, near, far)
+    intersect_distance.counted = True
+    return intersect_distance
+
+def _instrument(cls):
+    # Wrap the intersection test of every kind of shape, so each test gets counted
+    method = cls.__dict__.get("intersect_distance")
+    if method is not None and not getattr(method, "counted", False):
+        cls.intersect_distance = _counting(method, cls.__name__)
+    for subclass in cls.__subclasses__():
+        _instrument(subclass)
+
+def enable():
+    # Shapes defined after this is called won't have their tests counted
+    global current
+    if current is None:
+        current = Profile()
+        _instrument(Shapes.Shape)
+
+def enabled():
+    return current is not None
+
+#MARK: Collecting
+
+def begin():
+    # Starts a fresh profile, for a tile, returning the one it replaces
+    global current
+    previous = current
+    if previous is not None:
+        current = Profile()
+    return previous
+
+def end(previous):
+    # Puts the previous profile back, returning the one that was collected since begin()
+    global current
+    collected = current
+    current = previous
+    return collected
+
+def count(group, key, amount=1):
+    if current is not None:
+        current.count(group, key, amount)
+
+def merge(profile):
+    if current is not None and profile is not None:
+        current.merge(profile)
+
+@contextmanager
+def stage(name, **args):
+    # Times everything inside the with block as one span of the named stage
+    if current is None:
+        yield
+        return
+
+    start = time()
+    try:
+        yield
+    finally:
+        current.span(name, start, time(), **args)
+
+def pixel_times(times):
+    # Summarizes how long each pixel took
+    times = list(times)
+    summary = {"mean": mean(times), "median": median(times), "max": max(times)}
+    if current is not None:
+        current.details["time per pixel"] = summary
+    return summary
+
+def write(report_path=None, trace_path=None):
+    if current is None:
+        return
+    if report_path:
+        with open(report_path, 'w') as file:
+            json.dump(current.report(), file, indent=2)
+    if trace_path:
+        with open(trace_path, 'w') as file:
+            json.dump(current.chrome_trace(), file)
@@ -0,0 +1,127 @@
+##################
+# Progressive.py #
+##################
+# Rather than finishing each pixel before moving on,
+# a progressive render sweeps the whole frame in passes
+# of a few samples per pixel, adding each pass into a
+# running total. The image gets less noisy with every
+# pass, so there's always something to look at, and the
+# totals are saved every so often so that a render that
+# gets killed can pick back up where it left off.
+
+from copy import copy
+from functools import partial
+from time import time
+import os
+import pickle
+import signal
+import Camera
+import Parallel
+import Profiler
+import Writer
+from Utility.Framebuffer import Framebuffer, MAGIC
+
+# The options that decide what the image will look like; a checkpoint
+# remembers them so that a resumed render draws the same picture
+SCENE_OPTIONS = ('scene', 'prepared', 'seed', 'num_spheres', 'resolution', 'fov', 'depth', 'frustum', 'roulette', 'cutoff', 'sampler', 'denoise', 'progressive')
+
+def save(path, settings, framebuffer):
+    if framebuffer.path:
+        # A framebuffer kept in a file is its own checkpoint
+        framebuffer.flush(settings)
+        return
+
+    # Write to the side and swap it in, so being killed mid-save never ruins the last checkpoint
+    with open(path + ".tmp", 'wb') as file:
+        pickle.dump((settings, framebuffer), file, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+def load(path):
+    # Returns the settings and the Framebuffer saved in a checkpoint
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) == MAGIC:
+            framebuffer = Framebuffer.open(path)
+            return framebuffer.settings(), framebuffer
+        file.seek(0)
+        settings, framebuffer = pickle.load(file)
+    if not isinstance(framebuffer, Framebuffer):
+        raise ValueError("'{}' is not a checkpoint".format(path))
+    return settings, framebuffer
+
+def _terminate(signum, frame):
+    # Batch systems preempt jobs with SIGTERM; treat it just like ctrl-c
+    raise KeyboardInterrupt
+
+def capture(scene, camera, params, renderer=Camera.render_tile, farm=None):
+    accumulation = params.accumulation
+    if accumulation is None:
+        accumulation = Framebuffer(camera.width, camera.height, path=params.mapped, guides=camera.guides)
+    if params.multi > 1 and not farm and not accumulation.path:
+        # Let the worker processes add their samples straight into the totals
+        shared = accumulation.share()
+        accumulation.close()
+        accumulation = shared
+    settings = {name: getattr(params, name) for name in SCENE_OPTIONS}
+    checkpoint = accumulation.path or params.output[:-4] + ".checkpoint"
+    preview = params.output[:-4] + " preview.png"
+
+    # The workers keep their copy of the scene from one pass to the next
+    pool = Parallel.Pool(scene, params.multi) if params.multi > 1 and not farm else None
+    if pool:
+        farm = partial(pool.render, renderer, framebuffer=accumulation)
+
+    previous_handler = signal.signal(signal.SIGTERM, _terminate)
+    begin = last_checkpoint = time()
+
+    try:
+        while True:
+            # Every tile carries on from its own count, since a pass that was interrupted leaves some
+            # tiles a pass ahead of the rest, and they mustn't draw the same samples again
+            missing = {}
+            for tile in Camera.tiles(camera):
+                taken = int(accumulation.fewest(tile))
+                if taken < camera.samples:
+                    missing.setdefault(taken, []).append(tile)
+            if not missing:
+                break
+
+            # Every pass is its own little render, with only a few samples per pixel,
+            # and tiles that have taken the same samples get rendered together
+            for taken, todo in sorted(missing.items()):
+                sweep = copy(camera)
+                sweep.samples = min(params.progressive, camera.samples - taken)
+                sweep.first_sample = camera.first_sample + taken
+                sweep.threshold = None
+
+                with Profiler.stage("render", samples=sweep.samples):
+                    for _ in Camera.render(scene, sweep, params.multi, renderer, farm, accumulation, todo):
+                        pass
+            accumulation.passes += 1
+
+            if params.verbose:
+                print("Pass {}: {} samples per pixel, {:.2f}s elapsed".format(accumulation.passes, int(accumulation.fewest()), time() - begin))
+
+            if ((params.checkpoint_every and accumulation.passes % params.checkpoint_every == 0)
+                    or time() - last_checkpoint >= params.checkpoint_interval):
+                accumulation.develop()[0].save(preview, "PNG")
+                save(checkpoint, settings, accumulation)
+                last_checkpoint = time()
+    except KeyboardInterrupt:
+        print("Interrupted after {} passes".format(accumulation.passes))
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        if pool:
+            pool.close()
+
+    # Always leave a checkpoint behind, so more samples can be added later
+    save(checkpoint, settings, accumulation)
+    print("Total tracing time: {:.2f}s, checkpoint saved to '{}'".format(time() - begin, checkpoint))
+
+    with Profiler.stage("export"):
+        if params.writer:
+            Writer.Stream(accumulation, params.writer).finish()
+            images = None, accumulation.extras(params.extras)
+        else:
+            images = accumulation.develop(params.extras)
+    accumulation.close()
+    return images
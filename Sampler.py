@@ -0,0 +1,234 @@
+##############
+# Sampler.py #
+##############
+# A sampler decides the pair of numbers in [0, 1) that
+# each sample draws on at each bounce: where in its
+# pixel it lands, then which way it heads off every
+# surface it hits.
+#
+# Plain random numbers clump together and leave gaps,
+# so the noise only goes down with the square root of
+# the samples. The other samplers spread the samples
+# of a pixel out evenly over each pair, which gets to
+# the same noise with far fewer samples. Every sampler
+# works from the pixel's random streams, so renders
+# stay the same wherever each pixel is rendered.
+#
+# Only the stratified grid depends on how many samples
+# a pixel takes. The others keep the first samples the
+# same whatever the count, so a render can be resumed
+# or extended with more samples and stay well spread.
+#
+# Each sample is described by a (pixel, sample, stream)
+# tuple: its number within the pixel, between the keys
+# of its pixel and of its own stream in Utility/Streams.py.
+
+from abc import ABCMeta, abstractmethod
+from math import ceil, sqrt
+import Utility.Streams as Streams
+
+class Sampler(object):
+    """Hands out the numbers each sample uses to pick its position and bounces"""
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def pairs(self, keys, bounce):
+        # Must give a pair of numbers in [0, 1) for each (pixel, sample, stream)
+        # in keys, for the given bounce; the camera takes bounce 0
+        pass
+
+    def key(self):
+        # Everything that decides which numbers a sample gets, besides its keys
+        return (type(self).__name__,)
+
+class Independent(Sampler):
+    """Every number is drawn at random on its own"""
+
+    def __init__(self, count=None):
+        pass
+
+    def pairs(self, keys, bounce):
+        return Streams.uniforms([stream for _, _, stream in keys], bounce)
+
+def _permute(index, length, seed):
+    # Where index lands in a random shuffle of range(length) picked by seed, after
+    # Kensler's hash from "Correlated Multi-Jittered Sampling", which shuffles
+    # without having to write the whole shuffle out
+    mask = 1
+    while mask < length:
+        mask <<= 1
+    mask -= 1
+    seed &= Streams.HALF
+
+    while True:
+        # Hash within the next power of two up, until it lands back in range
+        index ^= seed
+        index = (index * 0xe170893d) & Streams.HALF
+        index ^= seed >> 16
+        index ^= (index & mask) >> 4
+        index ^= seed >> 8
+        index = (index * 0x0929eb3f) & Streams.HALF
+        index ^= seed >> 23
+        index ^= (index & mask) >> 1
+        index = (index * (1 | seed >> 27)) & Streams.HALF
+        index = (index * 0x6935fa69) & Streams.HALF
+        index ^= (index & mask) >> 11
+        index = (index * 0x74dcb303) & Streams.HALF
+        index ^= (index & mask) >> 2
+        index = (index * 0x9e501cc3) & Streams.HALF
+        index ^= (index & mask) >> 2
+        index = (index * 0xc860a3df) & Streams.HALF
+        index &= mask
+        index ^= index >> 5
+        if index < length:
+            return (index + seed) % length
+
+class Stratified(Sampler):
+    """Splits each pair into a grid of cells, and jitters one sample inside each cell"""
+
+    def __init__(self, count):
+        # As square a grid as there are samples to fill
+        self.side = int(ceil(sqrt(count)))
+        self.cells = self.side * self.side
+
+    def key(self):
+        return (type(self).__name__, self.cells)
+
+    def pairs(self, keys, bounce):
+        side = self.side
+        cells = self.cells
+        jitters = Streams.uniforms([stream for _, _, stream in keys], bounce)
+        # Every pixel visits the cells in a different order at each bounce, so where
+        # a sample lands isn't tied to the way it bounces
+        orders = {}
+
+        pairs = []
+        for (pixel, sample, _), (u, v) in zip(keys, jitters):
+            if pixel not in orders:
+                orders[pixel] = Streams.hash(pixel, bounce)
+            cell = _permute(sample % cells, cells, orders[pixel])
+            pairs.append(((cell % side + u) / side, (cell // side + v) / side))
+        return pairs
+
+def _primes(count):
+    # The first count primes
+    primes = []
+    candidate = 2
+    while len(primes) < count:
+        if all(candidate % prime for prime in primes):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+class Halton(Sampler):
+    """Radical inverses in a pair of prime bases for each bounce, shifted at random for every pixel"""
+
+    def __init__(self, count=None):
+        self.bases = []
+        # Radical inverses worked out so far, for each base
+        self._inverses = {}
+
+    def _inverse(self, base, index):
+        inverses = self._inverses.setdefault(base, [])
+        while len(inverses) <= index:
+            # Mirror the digits of the next index about the point
+            value, scale, remaining = 0.0, 1.0 / base, len(inverses)
+            while remaining:
+                remaining, digit = divmod(remaining, base)
+                value += digit * scale
+                scale /= base
+            inverses.append(value)
+        return inverses[index]
+
+    def pairs(self, keys, bounce):
+        if len(self.bases) < 2 * (bounce + 1):
+            self.bases = _primes(2 * (bounce + 1))
+        first, second = self.bases[2 * bounce:2 * bounce + 2]
+        shifts = {}
+
+        pairs = []
+        for pixel, sample, _ in keys:
+            if pixel not in shifts:
+                shifts[pixel] = Streams.uniforms([pixel], bounce)[0]
+            u, v = shifts[pixel]
+            # Cranley-Patterson rotation, wrapping around at 1
+            pairs.append(((self._inverse(first, sample) + u) % 1.0, (self._inverse(second, sample) + v) % 1.0))
+        return pairs
+
+# Sobol points are worked out from the low bits of a sample's index, which covers
+# this many samples a pixel before the pattern starts over
+SOBOL_BITS = 16
+
+def _reverse(bits):
+    # The 32 bits in the opposite order
+    return int('{:032b}'.format(bits)[::-1], 2)
+
+def _scramble(reversed, seed):
+    # A random nested shuffle of an index, given and returned with its bits reversed, after Laine
+    # and Karras's hash as used by Burley's "Practical Hash-based Owen Scrambling". Each bit of the
+    # index only ever depends on the bits above it, so the first 2, 4, 8... indices always shuffle
+    # among an aligned block of as many Sobol points, which are spread evenly however many of
+    # them a pixel goes on to take
+    reversed = (reversed + seed) & Streams.HALF
+    reversed ^= (reversed * 0x6c50b47c) & Streams.HALF
+    reversed ^= (reversed * 0xb82f1e52) & Streams.HALF
+    reversed ^= (reversed * 0xc7afe638) & Streams.HALF
+    reversed ^= (reversed * 0x8d22f6e6) & Streams.HALF
+    return reversed
+
+class Sobol(Sampler):
+    """The first two dimensions of the Sobol sequence, shuffled and scrambled for every pixel and bounce"""
+
+    def __init__(self, count=None):
+        # Sample numbers with their bits reversed, and points worked out so far as pairs
+        # of 32 bit fractions, both kept so they're only ever worked out once
+        self._reversed = []
+        self._points = {}
+
+    def _point(self, x):
+        # The first dimension of a point is its index with the bits reversed, which is
+        # all the second needs: it XORs together directions that each halve the last
+        point = self._points.get(x)
+        if point is None:
+            y = 0
+            direction = 1 << 31
+            for bit in range(31, 31 - SOBOL_BITS, -1):
+                if x >> bit & 1:
+                    y ^= direction
+                direction ^= direction >> 1
+            point = self._points[x] = (x, y)
+        return point
+
+    def pairs(self, keys, bounce):
+        reversed = self._reversed
+        scrambles = {}
+        # The low bits of an index are the high bits once reversed
+        mask = Streams.HALF ^ (Streams.HALF >> SOBOL_BITS)
+        period = 1 << SOBOL_BITS
+
+        pairs = []
+        for pixel, sample, _ in keys:
+            if pixel not in scrambles:
+                # A different order of the samples at every bounce, so a sample's position
+                # isn't tied to its bounces, and a random digital shift for every pixel.
+                # Neither depends on how many samples there are, so more can always be added
+                scrambles[pixel] = (Streams.hash(pixel, bounce) & Streams.HALF, Streams.hash(~pixel & Streams.MASK, bounce))
+            shuffle, shift = scrambles[pixel]
+            sample %= period
+            while len(reversed) <= sample:
+                reversed.append(_reverse(len(reversed)))
+            x, y = self._point(_scramble(reversed[sample], shuffle) & mask)
+            pairs.append(((x ^ (shift >> 32)) * Streams.SCALE, (y ^ (shift & Streams.HALF)) * Streams.SCALE))
+        return pairs
+
+SAMPLERS = {
+    "random": Independent,
+    "stratified": Stratified,
+    "halton": Halton,
+    "sobol": Sobol,
+}
+
+def create(name, count):
+    # Makes the named sampler, for pixels that take count samples each
+    return SAMPLERS[name](count)
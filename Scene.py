@@ -1,11 +1,31 @@
 from Utility.Vector import Vector
 import Materials
 import Shapes
+import BVH
+import Progressive
+import Distributed
+import Profiler
+import Sampler
+import Cache
+import SceneFile
+import Animation
+from Utility.Framebuffer import Framebuffer
 from Camera import *
+from random import Random
 
 # define constants
 up = Vector(0,0,1)
 
+# How many generated scenes are kept built at once, dropping the oldest first
+KEEP_BUILT = 4
+
+# Generated scenes built by this process so far, by what decides their shapes, with their views
+_built = {}
+
+# The options that build_and_draw needs to build a scene and its camera
+SETTINGS = ('scene', 'prepared', 'seed', 'num_spheres', 'resolution', 'fov', 'samples', 'depth',
+            'frustum', 'roulette', 'cutoff', 'adaptive', 'min_samples', 'sampler', 'packet', 'denoise', 'verbose')
+
 def prepared_scene(params):
     # Invent matter
     matte_white = Materials.Lambertian(Color.white)
@@ -22,35 +42,120 @@ def prepared_scene(params):
     scene.append(Shapes.Sphere(mirror, Vector(-5,270,7), 7))
     scene.append(Shapes.Sphere(gunmetal, Vector(13,285,20), 20))
 
-    # Build a camera obscura
-    camera = Camera(Vector(0,0,3),
-                    Vector(0,1,0),
-                    up,
-                    params.resolution,
-                    5.0,
-                    params.samples,
-                    params.depth,
-                    params.frustum)
+    # Set up a camera obscura
+    return scene, SceneFile.View(Vector(0,0,3), Vector(0,1,0), up, 5.0)
+
+def random_material(rng):
+    # Mostly matte, some metal, and a little glass
+    roll = rng.random()
+    tint = Color.Color(rng.uniform(0.2, 1.0), rng.uniform(0.2, 1.0), rng.uniform(0.2, 1.0))
 
-    return scene, camera
+    if roll < 0.6:
+        return Materials.Lambertian(tint)
+    elif roll < 0.85:
+        return Materials.Metallic(tint, rng.uniform(0.0, 0.3))
+    return Materials.Dielectric(Color.Color(rng.uniform(0.7, 1.0), rng.uniform(0.7, 1.0), rng.uniform(0.7, 1.0)),
+                                rng.uniform(1.3, 1.7))
 
 def random_scene(params):
-    camera = Camera(Vector(0,0,8),
-                    Vector(0,1,0),
-                    up,
-                    params.resolution,
-                    params.fov,
-                    params.samples,
-                    params.depth,
-                    params.frustum)
+    # Everything comes from our own generator, so the same seed always makes the same scene
+    rng = Random(params.seed)
+
+    min_radius, max_radius = 0.5, 2.0
+    spacing = 5.0
+
+    # Lay the spheres out on a square field in front of the camera, sized
+    # so that the density of the field stays the same however many there are.
+    # That density leaves most of the field empty, so a sphere that doesn't
+    # fit where it first lands soon finds somewhere that it does
+    side = (params.num_spheres * spacing ** 2) ** 0.5
+    left, near = -side / 2, max_radius
+
+    # Bucket spheres into a grid of cells at least one diameter across, so we
+    # only need to check the neighbouring cells for overlaps, not every sphere
+    cell = 2 * max_radius
+    grid = {}
+
+    scene = [Shapes.Plane(Materials.Lambertian(Color.lightgrey), Vector(0,0,0), up)]
+
+    for _ in range(params.num_spheres):
+        while True:
+            radius = rng.uniform(min_radius, max_radius)
+            center = Vector(left + rng.uniform(0, side), near + rng.uniform(0, side), radius)
+            i, j = int((center.x - left) // cell), int((center.y - near) // cell)
+
+            neighbours = (grid.get((i + di, j + dj), ()) for di in (-1, 0, 1) for dj in (-1, 0, 1))
+            if any(abs(center - other) < radius + other_radius for nearby in neighbours for other, other_radius in nearby):
+                continue
+
+            grid.setdefault((i, j), []).append((center, radius))
+            scene.append(Shapes.Sphere(random_material(rng), center, radius))
+            break
+
+    # The field of view is left to params
+    return scene, SceneFile.View(Vector(0,0,8), Vector(0,1,0), up, None)
+
+def make_camera(view, params):
+    # The camera stands where the scene's view puts it, and everything else comes from params
+    return Camera(view.position,
+                  view.direction,
+                  view.up,
+                  params.resolution,
+                  params.fov if view.fov is None else view.fov,
+                  params.samples,
+                  params.depth,
+                  params.frustum,
+                  params.adaptive,
+                  params.min_samples,
+                  params.seed,
+                  Sampler.create(params.sampler, params.samples),
+                  params.roulette,
+                  params.cutoff,
+                  params.denoise)
 
-    return [], camera
+def build(params):
+    # Everything about a scene follows from its params, so the same params always build the same scene
+    if params.scene:
+        # Scene files come with their hierarchy already built
+        view, scene = SceneFile.load(params.scene, params.verbose)
+
+        if params.verbose:
+            print("Scene loaded, Number of shapes: {}".format(sum(len(shape.shapes) if isinstance(shape, BVH.BVH) else 1 for shape in scene)))
+        return list(scene), make_camera(view, params)
+
+    # Only these decide what shapes a generated scene has, so a process that renders the same
+    # scene again, like the render service, can skip straight to the camera
+    key = ("prepared",) if params.prepared else ("random", params.seed, params.num_spheres)
+    if key not in _built:
+        scene, view = prepared_scene(params) if params.prepared else random_scene(params)
+
+        if params.verbose:
+            print("Scene built, Number of shapes: {}".format(len(scene)))
+
+        # Sort everything with bounds into a hierarchy so rays don't have to test every shape
+        if len(_built) >= KEEP_BUILT:
+            del _built[next(iter(_built))]
+        _built[key] = (BVH.accelerate(scene), view)
+
+    scene, view = _built[key]
+    return list(scene), make_camera(view, params)
+
+def renderer(params):
+    if params.packet:
+        # NumPy is only needed for the packet engine, so only import it if asked
+        import Packet
+        return Packet.render_tile
+    return render_tile
 
 def build_and_draw(params):
+    if params.profile or params.trace_events:
+        Profiler.enable()
+
     if params.verbose:
         begin = time()
 
-    scene, camera = prepared_scene(params) if params.prepared else random_scene(params)
+    with Profiler.stage("build"):
+        scene, camera = build(params)
 
     if params.debug:
         print(params)
@@ -58,7 +163,33 @@ def build_and_draw(params):
         print(scene)
 
     if params.verbose:
-        print("Scene built, Number of shapes: {}".format(len(scene)))
         print("Time to build scene: {:.2f}s".format(time() - begin))
 
-    return capture(scene, camera, params.verbose, params.heatmap)
+    farm = None
+    if params.coordinator:
+        # Workers get just enough to build the scene themselves
+        settings = {name: getattr(params, name) for name in SETTINGS}
+        settings["profiling"] = Profiler.enabled()
+        coordinator = Distributed.Coordinator(params.coordinator, params.authkey.encode(), settings, params.verbose)
+        farm = coordinator.render
+
+    try:
+        if params.progressive:
+            return Progressive.capture(scene, camera, params, renderer(params), farm)
+
+        cache = None
+        if params.cache:
+            cache = Cache.Cache(params.cache, int(params.cache_budget * 2 ** 20))
+
+        if params.animate:
+            return Animation.capture(scene, camera, params, renderer(params), farm, cache)
+
+        framebuffer = None
+        if params.mapped:
+            framebuffer = Framebuffer(camera.width, camera.height, path=params.mapped, guides=camera.guides)
+
+        return capture(scene, camera, params.verbose, params.extras, params.multi, renderer(params), farm, cache, framebuffer, params.writer)
+    finally:
+        if params.coordinator:
+            coordinator.close()
+        Profiler.write(params.profile, params.trace_events)
@@ -0,0 +1,248 @@
+################
+# SceneFile.py #
+################
+# Reads scenes from a file rather than from code. A
+# scene file is JSON (or TOML) that says where the
+# camera stands and lays out the materials and shapes:
+#
+#   {"camera": {"position": [0, 0, 3], "direction": [0, 1, 0], "fov": 5},
+#    "materials": {"glass": {"type": "Dielectric", "color": [0.73, 1, 0.82], "refr_index": 1.33}},
+#    "shapes": [{"type": "Plane", "material": {"type": "Lambertian", "color": "white"},
+#                "position": [0, 0, 0], "normal": [0, 0, 1]},
+#               {"type": "Sphere", "material": "glass", "position": [4, 260, 5], "radius": 5}]}
+#
+# Every field besides "type" is an argument of the
+# material or shape's constructor. Colors are lists of
+# three numbers or the names in Utility/Color.py, and a
+# shape's material is either a name from "materials" or
+# a material of its own. Meshes name an OBJ file, found
+# relative to the scene file:
+#
+#   {"type": "Mesh", "material": "glass", "path": "bunny.obj",
+#    "position": [0, 250, 0], "scale": 40}
+#
+# Building the shapes and their hierarchy is slow for
+# big scenes, so the result is pickled into a compiled
+# scene in a __pycache__ folder next to the file, named
+# after a hash of the file. Loading it again takes
+# moments, since hierarchies pickle to packed arrays.
+# The compiled scene notes the size and time of every
+# mesh file too, and is built again if any of them
+# have changed.
+
+from collections import namedtuple
+from hashlib import blake2b
+import gc
+import json
+import os
+import pickle
+import re
+from Utility.Vector import Vector
+import Utility.Color as Color
+import Materials
+import Shapes
+import BVH
+import Mesh
+
+try:
+    import tomllib
+except ImportError:
+    # Only Python 3.11 and up can read TOML
+    tomllib = None
+
+# Bumped whenever the way scenes are compiled changes, so old compiled scenes aren't loaded
+VERSION = 2
+
+# Where the camera stands and which way it looks; fov is None unless the file sets it
+View = namedtuple('View', 'position direction up fov')
+
+MATERIALS = {
+    "Lambertian": Materials.Lambertian,
+    "Metallic": Materials.Metallic,
+    "Dielectric": Materials.Dielectric,
+}
+
+SHAPES = {
+    "Plane": Shapes.Plane,
+    "Quadric": Shapes.Quadric,
+    "Sphere": Shapes.Sphere,
+    "Mesh": Mesh.Mesh,
+}
+
+# Fields that hold a point or a direction
+VECTORS = ('position', 'direction', 'normal', 'up')
+
+# Compiled scenes loaded by this process so far, by path, along with the hash of the file they came from
+# and the mesh files they read
+_loaded = {}
+
+#MARK: Reading
+
+def _number(value, where):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("{} should be a number, not {!r}".format(where, value))
+    return float(value)
+
+def _numbers(value, count, where):
+    if not isinstance(value, list) or len(value) != count:
+        raise ValueError("{} should be a list of {} numbers, not {!r}".format(where, count, value))
+    return [_number(item, where) for item in value]
+
+def _value(name, value, where):
+    # Turns a field into the argument its constructor expects
+    where = "{} '{}'".format(where, name)
+    if name == 'color':
+        if isinstance(value, str):
+            if not isinstance(getattr(Color, value, None), Color.Color):
+                raise ValueError("{}: there's no color named '{}'".format(where, value))
+            return getattr(Color, value)
+        return Color.Color._make(_numbers(value, 3, where))
+    if name in VECTORS:
+        return Vector._make(_numbers(value, 3, where))
+    if name == 'equation':
+        return _numbers(value, 10, where)
+    return _number(value, where)
+
+def _path(value, where, folder):
+    if not isinstance(value, str):
+        raise ValueError("{} 'path' should be a file name, not {!r}".format(where, value))
+    return os.path.join(folder, value)
+
+def _make(kinds, description, where, materials, folder=""):
+    if not isinstance(description, dict) or description.get("type") not in kinds:
+        raise ValueError("{} should have a type of {}".format(where, ", ".join(sorted(kinds))))
+
+    arguments = {}
+    for name, value in description.items():
+        if name == "type":
+            continue
+        if name == "material" and materials is not None:
+            arguments[name] = _material(value, where, materials)
+        elif name == "path":
+            arguments[name] = _path(value, where, folder)
+        else:
+            arguments[name] = _value(name, value, where)
+
+    try:
+        return kinds[description["type"]](**arguments)
+    except TypeError as error:
+        raise ValueError("{}: {}".format(where, error))
+    except OSError as error:
+        raise ValueError("{}: can't read '{}' ({})".format(where, arguments["path"], error.strerror))
+
+def _material(value, where, materials):
+    # Materials with the same description are the same material, whether named or not
+    if isinstance(value, str):
+        if value not in materials:
+            raise ValueError("{}: there's no material named '{}'".format(where, value))
+        return materials[value]
+
+    key = json.dumps(value, sort_keys=True)
+    if key not in materials:
+        materials[key] = _make(MATERIALS, value, "{} material".format(where), None)
+    return materials[key]
+
+def parse(data, extension):
+    # The scene described by the contents of a file
+    if extension.lower() == ".toml":
+        if tomllib is None:
+            raise ValueError("Reading TOML scenes needs Python 3.11 or later")
+        return tomllib.loads(data.decode())
+    return json.loads(data.decode())
+
+def build(description, folder=""):
+    # Builds the View and the shapes a parsed scene file describes, with the shapes already
+    # sorted into their hierarchy. Files the shapes name are found relative to folder
+    if not isinstance(description, dict):
+        raise ValueError("A scene should be an object with camera, materials and shapes")
+
+    camera = description.get("camera")
+    if not isinstance(camera, dict) or "position" not in camera or "direction" not in camera:
+        raise ValueError("The scene's camera needs a position and a direction")
+    view = View(_value('position', camera["position"], "camera"),
+                _value('direction', camera["direction"], "camera"),
+                _value('up', camera.get("up", [0, 0, 1]), "camera"),
+                _number(camera["fov"], "camera 'fov'") if "fov" in camera else None)
+
+    materials = {}
+    for name, material in description.get("materials", {}).items():
+        materials[name] = _make(MATERIALS, material, "material '{}'".format(name), None)
+
+    shapes = description.get("shapes", [])
+    if not isinstance(shapes, list):
+        raise ValueError("The scene's shapes should be a list")
+    scene = [_make(SHAPES, shape, "shape {}".format(number), materials, folder) for number, shape in enumerate(shapes)]
+
+    return view, BVH.accelerate(scene)
+
+#MARK: Loading
+
+def _compiled_path(path, digest):
+    folder, name = os.path.split(os.path.abspath(path))
+    return os.path.join(folder, "__pycache__", "{}.{}.scene".format(name, digest))
+
+def _sources(description, folder):
+    # The files the shapes of a parsed scene file read, with their sizes and modification times
+    sources = []
+    for shape in description.get("shapes", []):
+        if isinstance(shape, dict) and isinstance(shape.get("path"), str):
+            source = _path(shape["path"], "", folder)
+            status = os.stat(source)
+            sources.append((source, status.st_size, status.st_mtime_ns))
+    return sources
+
+def _unchanged(sources):
+    # Whether every file is still the size and age it was when the scene was compiled
+    try:
+        return all((os.stat(source).st_size, os.stat(source).st_mtime_ns) == (size, time) for source, size, time in sources)
+    except OSError:
+        return False
+
+def _save(path, digest, compiled):
+    # Compiling again next time is no great loss, so a folder we can't write to is fine
+    target = _compiled_path(path, digest)
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary = "{}.{}.tmp".format(target, os.getpid())
+        with open(temporary, 'wb') as file:
+            pickle.dump(compiled, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, target)
+
+        # Clear out what was compiled from older versions of the file
+        older = re.compile(re.escape(os.path.basename(path)) + r"\.[0-9a-f]{32}\.scene")
+        for entry in os.scandir(os.path.dirname(target)):
+            if entry.path != target and older.fullmatch(entry.name):
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+def load(path, verbose=False):
+    # The View and the shapes of a scene file, compiling it only if it has changed since it was last compiled
+    with open(path, 'rb') as file:
+        data = file.read()
+    digest = blake2b(data, digest_size=16, person=str(VERSION).encode()).hexdigest()
+
+    if path in _loaded and _loaded[path][0] == digest and _unchanged(_loaded[path][1]):
+        return _loaded[path][2]
+
+    try:
+        with open(_compiled_path(path, digest), 'rb') as file:
+            # Nothing made while loading is garbage, so don't let the collector keep sweeping over it
+            gc.disable()
+            try:
+                sources, compiled = pickle.load(file)
+            finally:
+                gc.enable()
+        if not _unchanged(sources):
+            raise ValueError("A mesh file has changed")
+        if verbose:
+            print("Loaded compiled scene for '{}'".format(path))
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+        description = parse(data, os.path.splitext(path)[1])
+        folder = os.path.dirname(path)
+        compiled = build(description, folder)
+        sources = _sources(description, folder)
+        _save(path, digest, (sources, compiled))
+
+    _loaded[path] = (digest, sources, compiled)
+    return compiled
@@ -0,0 +1,509 @@
+##############
+# Service.py #
+##############
+# Keeps the tracer running as a local render service,
+# so a pipeline that renders one job after another
+# doesn't pay for starting Python, importing everything,
+# building the scene and starting worker processes
+# before every single image.
+#
+# A job takes exactly the options of the command line,
+# as a JSON list, and waits in a queue, highest priority
+# first and otherwise in the order they came in. One
+# job renders at a time. Scenes stay built from one job
+# to the next, and a scene rendered with --multi keeps
+# its pool of worker processes, which already hold their
+# copy of it.
+#
+#   POST /jobs            {"args": ["--scene", "room.json", "-s", "4"], "priority": 1}
+#                         queues a job, and answers with its number
+#   GET /jobs             how every job the service remembers is getting on
+#   GET /jobs/N           how job N is getting on
+#   GET /jobs/N/progress  the same, as another line of JSON every time a tile finishes
+#   GET /jobs/N/image     the image, sent as its rows come in
+#   DELETE /jobs/N        takes job N out of the queue, if it hasn't started
+#   POST /render          queues a job and sends its image back, all in one request
+#
+# The image is in the format of the extension given to
+# -o, or PNG without one, and no images or checkpoints
+# are written on the server; the only thing that is, is
+# the compiled copy of a --scene file, in a __pycache__
+# folder next to it. PNG and PPM are sent a strip of rows at a time
+# as they're traced; other formats once they're done.
+# If a job fails halfway, its image stops short, and
+# GET /jobs/N says why.
+#
+# Anyone who can reach the service can have it read any
+# scene file it can, so only listen on localhost, or on
+# a Unix socket that only you can open.
+
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+from heapq import heappush, heappop
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from itertools import count
+from optparse import OptionParser
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Thread, Condition
+from time import time
+import json
+import mimetypes
+import os
+import signal
+import stat
+from Utility.Framebuffer import Framebuffer
+import Utility.Color as Color
+import Camera
+import Distributed
+import Parallel
+import Scene
+import Writer
+
+# Options that make no sense for one image sent back over a connection, by the attribute they set
+REFUSED = (('--progressive', 'progressive'), ('--resume', 'resume'), ('--animate', 'animate'),
+           ('--mapped', 'mapped'), ('--coordinator', 'coordinator'), ('--worker', 'worker'),
+           ('--serve', 'serve'), ('--profile', 'profile'), ('--trace-events', 'trace_events'),
+           ('--heatmap', 'heatmap'), ('--sample-map', 'sample_map'), ('--cache', 'cache'))
+
+# Formats that are written from front to back, and can be sent before they're finished
+SEQUENTIAL = ('.png', '.ppm')
+
+# How many finished jobs are remembered, for anyone still asking after them
+KEEP_JOBS = 100
+
+class _JobParser(OptionParser):
+    """Reads a job's options like the command line does, but complains with an exception rather than exiting"""
+
+    def error(self, message):
+        raise ValueError(message)
+
+    def exit(self, status=0, message=None):
+        raise ValueError(message or "Nothing to render")
+
+class Job(object):
+    """A render, from waiting in the queue to its finished image"""
+
+    def __init__(self, number, params, priority):
+        self.number = number
+        self.params = params
+        self.priority = priority
+        self.extension = os.path.splitext(params.output)[1].lower()
+        self.state = "queued"
+        self.error = None
+        self.tiles = 0
+        self.finished_tiles = 0
+        self.rays = 0
+        self.times = {"queued": time()}
+
+        # The image as it's written, with the job standing in for its file
+        self.image = BytesIO()
+
+        # Held to change anything about the job, and notified whenever something does
+        self.changed = Condition()
+        self.version = 0
+
+    #MARK: Progress
+
+    def _update(self):
+        self.version += 1
+        self.changed.notify_all()
+
+    def begin(self, tiles):
+        # Starts rendering, unless the job has been cancelled in the meantime
+        with self.changed:
+            if self.state != "queued":
+                return False
+            self.state = "rendering"
+            self.tiles = tiles
+            self.times["started"] = time()
+            self._update()
+            return True
+
+    def advance(self, rays):
+        with self.changed:
+            self.finished_tiles += 1
+            self.rays += rays
+            self._update()
+
+    def finish(self, state, error=None):
+        with self.changed:
+            self.state = state
+            self.error = error
+            self.times["finished"] = time()
+            self._update()
+
+    def finished(self):
+        return self.state in ("done", "failed", "cancelled")
+
+    def status(self):
+        with self.changed:
+            now = self.times.get("finished", time())
+            started = self.times.get("started")
+            return {"job": self.number, "state": self.state, "priority": self.priority,
+                    "tiles": self.tiles, "finished_tiles": self.finished_tiles, "rays": self.rays,
+                    "waited": round((started or now) - self.times["queued"], 3),
+                    "rendered": round(now - started, 3) if started else 0.0,
+                    "error": self.error}
+
+    #MARK: The image
+
+    def write(self, data):
+        with self.changed:
+            self.image.write(data)
+
+    def seek(self, offset, whence=0):
+        with self.changed:
+            return self.image.seek(offset, whence)
+
+    def flush(self):
+        # Writers flush after every strip, which is when there's more to send
+        with self.changed:
+            self._update()
+
+    def available(self):
+        # How much of the image can be sent so far; held under changed
+        if self.extension in SEQUENTIAL or self.state == "done":
+            return len(self.image.getbuffer())
+        return 0
+
+    def read(self, start, end):
+        with self.changed:
+            with self.image.getbuffer() as view:
+                return bytes(view[start:end])
+
+class Service(object):
+    """The queue of jobs, and the worker pools kept ready for them"""
+
+    def __init__(self, options, check, keep_warm=2, verbose=False):
+        # Jobs are read with the command line's own options and checks
+        self._options = options
+        self._check = check
+        self._keep_warm = keep_warm
+        self._verbose = verbose
+
+        self._lock = Condition()
+        self._queue = []
+        self._jobs = OrderedDict()
+        self._numbers = count(1)
+        self._closed = False
+
+        # Pools by the shapes their workers hold and how many workers there are, least recently used first.
+        # Only the runner thread touches these
+        self._pools = OrderedDict()
+
+        self._runner = Thread(target=self._run, daemon=True)
+        self._runner.start()
+
+    def parse(self, args):
+        # The params of a job, or a ValueError saying what's wrong with its options
+        parser = self._options(_JobParser(add_help_option=False))
+        params, rest = parser.parse_args(list(args))
+        self._check(parser, params, rest)
+
+        refused = [option for option, name in REFUSED if getattr(params, name)]
+        if refused:
+            raise ValueError("{} can't be used with the render service".format(", ".join(refused)))
+
+        if params.output is None:
+            setattr(params,"output","render.png")
+        if params.seed is None:
+            # Just like the command line, a day's worth of jobs share the same random scene
+            setattr(params,"seed",int(datetime.now().strftime("%Y%m%d")))
+        setattr(params,"extras",[])
+        return params
+
+    #MARK: The queue
+
+    def submit(self, args, priority=0):
+        params = self.parse(args)
+        with self._lock:
+            job = Job(next(self._numbers), params, priority)
+            self._jobs[job.number] = job
+            heappush(self._queue, (-priority, job.number))
+
+            # Forget the oldest finished jobs, once there are too many to keep
+            finished = [number for number, old in self._jobs.items() if old.finished()]
+            for number in finished[:max(len(finished) - KEEP_JOBS, 0)]:
+                del self._jobs[number]
+
+            self._lock.notify_all()
+
+        if self._verbose:
+            print("Job {} queued with priority {}: {}".format(job.number, priority, " ".join(args)))
+        return job
+
+    def job(self, number):
+        with self._lock:
+            return self._jobs.get(number)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def ahead(self, job):
+        # How many jobs will start before this one
+        with self._lock:
+            # Jobs that were cancelled and since forgotten can still be in the queue, but never start
+            return sum(1 for entry in self._queue if entry < (-job.priority, job.number)
+                       and getattr(self._jobs.get(entry[1]), "state", None) == "queued")
+
+    def cancel(self, job):
+        # Takes the job out of the queue, as long as it hasn't started. It's skipped once it comes up
+        with job.changed:
+            if job.state != "queued":
+                return False
+            job.finish("cancelled")
+            return True
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self._runner.join()
+
+    #MARK: Rendering
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._lock.wait()
+                if self._closed:
+                    break
+                _, number = heappop(self._queue)
+                job = self._jobs.get(number)
+
+            if job is not None and job.state == "queued":
+                self._render(job)
+
+        for _, pool in self._pools.values():
+            pool.close()
+
+    def _pool(self, scene, workers):
+        # A pool whose workers already hold this scene, starting one if there isn't one
+        key = (tuple(map(id, scene)), workers)
+        if key not in self._pools:
+            # Holding on to the scene keeps the ids in the key from being reused by other shapes
+            self._pools[key] = (scene, Parallel.Pool(scene, workers))
+        self._pools.move_to_end(key)
+        return self._pools[key][1]
+
+    def _render(self, job):
+        params = job.params
+        begin = time()
+        try:
+            # Built scenes are kept by Scene and SceneFile, so this is quick for a scene seen before
+            scene, camera = Scene.build(params)
+            renderer = Scene.renderer(params)
+            pool = self._pool(scene, params.multi) if params.multi > 1 else None
+
+            framebuffer = Framebuffer(camera.width, camera.height, shared=pool is not None, guides=camera.guides)
+            try:
+                # The pool stands in for a farm, rendering straight into this job's framebuffer
+                farm = partial(pool.render, renderer, framebuffer=framebuffer) if pool else None
+                if not job.begin(len(list(Camera.tiles(camera)))):
+                    return
+
+                results = Camera.render(scene, camera, 1, renderer, farm, framebuffer)
+
+                writer = Writer.create(job, job.extension, camera.width, camera.height)
+                stream = Writer.Stream(framebuffer, writer) if writer else None
+                for result in results:
+                    if stream:
+                        stream.add(result.tile)
+                    job.advance(result.rays)
+
+                if stream:
+                    stream.finish()
+                else:
+                    image = BytesIO()
+                    Color.save(framebuffer.develop()[0], image, job.extension)
+                    job.write(image.getvalue())
+            finally:
+                framebuffer.close()
+
+            job.finish("done")
+        except Exception as error:
+            # A job that goes wrong mustn't take the service down with it
+            job.finish("failed", str(error) or type(error).__name__)
+        finally:
+            # Let go of the pools that haven't been used for longest
+            while len(self._pools) > self._keep_warm:
+                _, (_, pool) = self._pools.popitem(last=False)
+                pool.close()
+
+        if self._verbose:
+            print("Job {} {} in {:.2f}s".format(job.number, job.state, time() - begin))
+
+#MARK: HTTP
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answers a request by handing it to the service"""
+
+    server_version = "PythonRayTracer/1.0"
+
+    def address_string(self):
+        # Clients on a Unix socket don't have an address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _reply(self, code, body):
+        data = (json.dumps(body) + "\n").encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _status(self, job):
+        status = job.status()
+        if status["state"] == "queued":
+            status["ahead"] = self.server.service.ahead(job)
+        return status
+
+    def _job(self):
+        # The job and what's wanted of it, for paths like /jobs/N/image, or None after replying with an error
+        parts = self.path.strip("/").split("/")
+        job = None
+        if len(parts) in (2, 3) and parts[0] == "jobs" and parts[1].isdigit():
+            job = self.server.service.job(int(parts[1]))
+        if job is None:
+            self._reply(404, {"error": "No such job"})
+            return None, None
+        return job, parts[2] if len(parts) == 3 else None
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/jobs":
+            return self._reply(200, [self._status(job) for job in self.server.service.jobs()])
+
+        job, part = self._job()
+        if job is None:
+            return
+        if part is None:
+            self._reply(200, self._status(job))
+        elif part == "progress":
+            self._progress(job)
+        elif part == "image":
+            self._image(job)
+        else:
+            self._reply(404, {"error": "Jobs have a progress and an image"})
+
+    def do_DELETE(self):
+        job, part = self._job()
+        if job is None:
+            return
+        if part is not None:
+            return self._reply(404, {"error": "Only jobs can be cancelled"})
+        if not self.server.service.cancel(job):
+            return self._reply(409, {"error": "Job {} has already started".format(job.number)})
+        self._reply(200, self._status(job))
+
+    def do_POST(self):
+        if self.path not in ("/jobs", "/render"):
+            return self._reply(404, {"error": "Post jobs to /jobs, or to /render to wait for the image"})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode() or "{}")
+            if not isinstance(request, dict):
+                raise ValueError("A job should be an object with args and a priority")
+            args, priority = request.get("args", []), request.get("priority", 0)
+            if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+                raise ValueError("A job's args should be a list of strings, like the command line")
+            if not isinstance(priority, int) or isinstance(priority, bool):
+                raise ValueError("A job's priority should be a whole number")
+            job = self.server.service.submit(args, priority)
+        except ValueError as error:
+            return self._reply(400, {"error": str(error)})
+
+        if self.path == "/jobs":
+            self._reply(202, self._status(job))
+        else:
+            self._image(job)
+
+    def _progress(self, job):
+        # A line of JSON every time the job changes, until it's finished
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        seen = None
+        while True:
+            with job.changed:
+                job.changed.wait_for(lambda: job.version != seen)
+                seen = job.version
+            status = self._status(job)
+            try:
+                self.wfile.write((json.dumps(status) + "\n").encode())
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if status["state"] in ("done", "failed", "cancelled"):
+                return
+
+    def _image(self, job):
+        # Waits for the first of the image, then sends it along as the rest comes in
+        with job.changed:
+            job.changed.wait_for(lambda: job.available() or job.finished())
+            empty = not job.available()
+        if empty:
+            return self._reply(409 if job.state == "cancelled" else 500, self._status(job))
+
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.types_map.get(job.extension, "application/octet-stream"))
+        self.end_headers()
+
+        sent = 0
+        while True:
+            with job.changed:
+                job.changed.wait_for(lambda: job.available() > sent or job.finished())
+                end = job.available()
+                last = job.finished()
+            try:
+                self.wfile.write(job.read(sent, end))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            sent = end
+            if last:
+                return
+
+class _UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def _stop(signum, frame):
+    # Being told to stop is the same as an interrupt, so everything gets shut down properly
+    raise KeyboardInterrupt
+
+def serve(address, options, check, keep_warm=2, verbose=False):
+    # Renders jobs until interrupted, taking them over HTTP on [HOST:]PORT or on a Unix socket at any other address
+    service = Service(options, check, keep_warm, verbose)
+    try:
+        server = ThreadingHTTPServer(Distributed.parse_address(address), _Handler)
+        where = "http://{}:{}".format(*server.server_address[:2])
+        socket = None
+    except ValueError:
+        # Whatever was left at the path by a service that didn't get to clean up goes
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+        where, socket = address, address
+
+    server.service = service
+    server.verbose = verbose
+    signal.signal(signal.SIGTERM, _stop)
+    print("Rendering jobs sent to {}".format(where))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket:
+            os.remove(socket)
@@ -16,10 +16,38 @@ class Shape(object):
     __metaclass__ = ABCMeta
 
     @abstractmethod
-    def intersect_ray(self, ray, frustum):
-        # Must include a way for the shape to calculate ray intersection
+    def intersect_distance(self, ray, near, far):
+        # Must include a way for the shape to calculate how far along the ray
+        # it gets hit, or None if it doesn't get hit between near and far
+        pass
+
+    @abstractmethod
+    def intersection(self, ray, distance):
+        # Must be able to fill in the Intersection for a hit at that distance
         pass
 
+    # Intersecting is split in two: finding out how far away a shape is is
+    # cheap, and the point and normal are only worked out for whichever
+    # shape turns out to be the closest, once it's known
+
+    def nearest_hit(self, ray, near, far):
+        # The distance and the shape that was hit, or None; groups of shapes override this
+        distance = self.intersect_distance(ray, near, far)
+        return None if distance is None else (distance, self)
+
+    def intersect_ray(self, ray, frustum):
+        hit = self.nearest_hit(ray, frustum.near, frustum.far)
+        return hit[1].intersection(ray, hit[0]) if hit else None
+
+    def occludes(self, ray, near, far):
+        # Whether the ray hits the shape at all, for when any hit will do
+        return self.intersect_distance(ray, near, far) is not None
+
+    def bounds(self):
+        # The (lower, upper) corners of an axis-aligned box around the shape,
+        # or None if the shape goes on forever
+        return None
+
 Intersection = namedtuple('Intersection', 'distance point normal material')
 
 class Plane(Shape):
@@ -32,20 +60,25 @@ class Plane(Shape):
         # Constant value so we don't calculate it every time
         self._n_dot_p = dot(self._normal, self._position)
 
-    def intersect_ray(self, ray, frustum):
-        denominator = dot(self._normal, ray.direction)
+    def intersect_distance(self, ray, near, far):
+        nx, ny, nz = self._normal
+        dx, dy, dz = ray.direction
+        denominator = nx * dx + ny * dy + nz * dz
 
-        if denominator is 0.0:
+        # Parallel to the plane
+        if denominator == 0.0:
             return None
 
-        distance = (self._n_dot_p - dot(self._normal, ray.origin)) / denominator
+        ox, oy, oz = ray.origin
+        distance = (self._n_dot_p - (nx * ox + ny * oy + nz * oz)) / denominator
 
-        if frustum.near <= distance <= frustum.far:
-            return Intersection(distance,
-                                ray.project(distance),
-                                self._normal,
-                                self._material)
-        return None
+        return distance if near <= distance <= far else None
+
+    def intersection(self, ray, distance):
+        return Intersection(distance,
+                            ray.project(distance),
+                            self._normal,
+                            self._material)
 
 Equation = namedtuple('Equation', 'A B C D E F G H I J')
 
@@ -56,50 +89,60 @@ class Quadric(Shape):
     def __init__(self, material, position, equation):
         self._material = material
         self._position = Vector._make(position)
-        self._equation = Equation._make(equation)
-        # Prepare ABC, DEF, and GHI vectors per the equation
-        self._ABC = Vector._make(self._equation[0:3])
-        self._DEF = Vector._make(self._equation[3:6])
-        self._GHI = Vector._make(self._equation[6:9])
+        self._equation = Equation._make(float(term) for term in equation)
+        # Quadrics without any cross or linear terms (axis-aligned ellipsoids,
+        # cylinders and cones centered on their position) get a shorter formula
+        self._axis_aligned = not any(self._equation[3:9])
+
+    def bounds(self):
+        # Only axis-aligned ellipsoids (including spheres) are known to be closed
+        A, B, C, D, E, F, G, H, I, J = self._equation
+        if D or E or F or A <= 0 or B <= 0 or C <= 0:
+            return None
+
+        # Completing the square gives A(x + G/A)² + B(y + H/B)² + C(z + I/C)² = K
+        K = G**2 / A + H**2 / B + I**2 / C - J
+        if K < 0:
+            return None
+
+        center = self._position - Vector(G / A, H / B, I / C)
+        extent = Vector((K / A) ** 0.5, (K / B) ** 0.5, (K / C) ** 0.5)
+        return center - extent, center + extent
 
     def _get_normal(self, point):
-        relative = point - self._position
+        a, b, c, d, e, f, g, h, i, j = self._equation
+        px, py, pz = self._position
+        x, y, z = point
+        x, y, z = x - px, y - py, z - pz
         # Compute the generic derivative of the equation at given point
-        x = (2 * self._equation.A * relative.x
-             + self._equation.E * relative.z
-             + self._equation.F * relative.y
-             + self._equation.G)
-        y = (2 * self._equation.B * relative.y
-             + self._equation.D * relative.z
-             + self._equation.F * relative.x
-             + self._equation.H)
-        z = (2 * self._equation.C * relative.z
-             + self._equation.D * relative.y
-             + self._equation.E * relative.x
-             + self._equation.I)
-        return Vector(x,y,z).unit()
-
-    def _calculate_intersection(self, ray, frustum):
+        return unit(2 * a * x + e * z + f * y + g,
+                    2 * b * y + d * z + f * x + h,
+                    2 * c * z + d * y + e * x + i)
+
+    def intersect_distance(self, ray, near, far):
+        # Everything here is done on plain floats, to avoid building a Vector for every term
+        a, b, c, d, e, f, g, h, i, j = self._equation
+
         # Calculate the positions of the camera and the ray relative to the quadric
-        rCam = ray.origin - self._position
-        rRay = ray.direction
-
-        # Precalculate these values for our quadratic equation
-        V1 = rRay * rRay
-        V2 = Vector(rRay.x * rRay.y, rRay.y * rRay.z, rRay.z * rRay.x) * 2
-        V3 = rCam * rRay
-        V4 = Vector(rRay.x * rCam.y + rCam.x * rRay.y,
-                    rCam.y * rRay.z + rRay.y * rCam.z,
-                    rCam.x * rRay.z + rRay.x * rCam.z)
-        V5 = rRay
-        V6 = rCam * rCam
-        V7 = Vector(rCam.x * rCam.y, rCam.y * rCam.z, rCam.z * rCam.x) * 2
-        V8 = rCam * 2
+        ox, oy, oz = ray.origin
+        px, py, pz = self._position
+        cx, cy, cz = ox - px, oy - py, oz - pz
+        dx, dy, dz = ray.direction
 
         # Calculate the quadratic coefficients
-        A = dot(self._ABC, V1) + dot(self._DEF, V2)
-        B = dot(self._ABC, V3) + dot(self._DEF, V4) + dot(self._GHI, V5)
-        C = dot(self._ABC, V6) + dot(self._DEF, V7) + dot(self._GHI, V8) + self._equation[9]
+        if self._axis_aligned:
+            A = a * dx * dx + b * dy * dy + c * dz * dz
+            B = a * cx * dx + b * cy * dy + c * cz * dz
+            C = a * cx * cx + b * cy * cy + c * cz * cz + j
+        else:
+            A = (a * dx * dx + b * dy * dy + c * dz * dz
+                 + 2 * (d * dy * dz + e * dx * dz + f * dx * dy))
+            B = (a * cx * dx + b * cy * dy + c * cz * dz
+                 + d * (cy * dz + dy * cz) + e * (cx * dz + dx * cz) + f * (cx * dy + dx * cy)
+                 + g * dx + h * dy + i * dz)
+            C = (a * cx * cx + b * cy * cy + c * cz * cz
+                 + 2 * (d * cy * cz + e * cx * cz + f * cx * cy)
+                 + 2 * (g * cx + h * cy + i * cz) + j)
 
         # Calculate the squared value for our quadratic formula
         square = B ** 2 - A * C
@@ -116,29 +159,83 @@ class Quadric(Shape):
         D2 = (-B + root) / A
 
         # Return closest intersection thats in the frustum
-        if frustum.near <= D1 <= frustum.far:
+        if near <= D1 <= far:
             return D1
-        elif frustum.near <= D2 <= frustum.far:
+        elif near <= D2 <= far:
             return D2
         return None
 
-    def intersect_ray(self, ray, frustum):
-        distance = self._calculate_intersection(ray, frustum)
-
-        if distance is None:
-            return None
-
+    def intersection(self, ray, distance):
         intersect = ray.project(distance)
         normal = self._get_normal(intersect)
 
         return Intersection(distance, intersect, normal, self._material)
 
 class Sphere(Quadric):
-    """Redefinition of spheres to override the normal function for a simpler one"""
+    """Redefinition of spheres to override the intersection and normal functions for simpler ones"""
 
     def __init__(self, material, position, radius):
         super().__init__(material, position, (1,1,1,0,0,0,0,0,0,-(radius**2)))
+        self._radius_squared = float(radius ** 2)
+
+    def intersect_distance(self, ray, near, far):
+        # With a unit direction, the quadratic for a sphere boils down to
+        # t² + 2bt + c = 0 where b = oc·d and c = |oc|² - r²
+        ox, oy, oz = ray.origin
+        px, py, pz = self._position
+        cx, cy, cz = ox - px, oy - py, oz - pz
+        dx, dy, dz = ray.direction
+
+        B = cx * dx + cy * dy + cz * dz
+        C = cx * cx + cy * cy + cz * cz - self._radius_squared
+
+        # Starting outside and heading away can never hit
+        if C > 0 and B > 0:
+            return None
+
+        square = B * B - C
+        if square < 0:
+            return None
+
+        root = square ** 0.5
+        D1 = -B - root
+        D2 = -B + root
+
+        # Return closest intersection thats in the frustum
+        if near <= D1 <= far:
+            return D1
+        elif near <= D2 <= far:
+            return D2
+        return None
+
+    def occludes(self, ray, near, far):
+        # Any hit will do, so throw out the rays that can't hit between near and far before taking a root
+        ox, oy, oz = ray.origin
+        px, py, pz = self._position
+        cx, cy, cz = ox - px, oy - py, oz - pz
+        dx, dy, dz = ray.direction
+
+        B = cx * dx + cy * dy + cz * dz
+        C = cx * cx + cy * cy + cz * cz - self._radius_squared
+
+        # Starting outside and heading away, or missing altogether
+        if C > 0 and B > 0:
+            return False
+        square = B * B - C
+        if square < 0:
+            return False
+
+        # The hits lie within a radius of -B, so the sphere is past far or short of near when
+        # that whole span is, which compares squares and needs no root
+        past, short = -B - far, near + B
+        if (past > 0 and past * past > self._radius_squared) or (short > 0 and short * short > self._radius_squared):
+            return False
+
+        root = square ** 0.5
+        return near <= -B - root <= far or near <= -B + root <= far
 
     def _get_normal(self, point):
         # Override Quadric's normal function with this faster calculation
-        return (point - self._position).unit()
+        x, y, z = point
+        px, py, pz = self._position
+        return unit(x - px, y - py, z - pz)
@@ -3,12 +3,19 @@
 from optparse import OptionParser, OptionGroup
 from datetime import datetime
 import os
+import pickle
 import Scene
-
-def main():
+import SceneFile
+import Animation
+import Progressive
+import Distributed
+import Service
+import Sampler
+import Writer
+import Utility.Color as Color
+
+def options(parser):
     # Define all the options for the ray tracing environment
-    parser = OptionParser(version="1.0")
-
     parser.add_option("-v", "--verbose", action="store_true", default=False,
                       help="Flag for output of detailed render and timing information.")
     parser.add_option("--debug", action="store_true", default=False,
@@ -17,8 +24,20 @@ def main():
                       help="Specify the name of the output file.")
     parser.add_option("--heatmap", action="store_true", default=False,
                       help="Outputs a second image heatmap of the pixels that took the most time.")
+    parser.add_option("--sample-map", action="store_true", default=False,
+                      help="Outputs another image showing how many samples each pixel took.")
     parser.add_option("-m", "--multi", metavar="THREADS", type="int", default=1,
-                      help="Number of threads to use while rendering. Default: 1.")
+                      help="Number of worker processes to use while rendering. Default: 1.")
+    parser.add_option("--packet", action="store_true", default=False,
+                      help="Trace whole packets of rays at once with the vectorized NumPy engine.")
+    parser.add_option("--denoise", action="store_true", default=False,
+                      help="Record the color, normal and distance of what each pixel sees first, and use them to filter the noise out of the image. Needs NumPy.")
+    parser.add_option("--mapped", metavar="FILENAME",
+                      help="Keep the running totals in this file rather than in memory, for images too big for RAM. With --progressive, it's the checkpoint too.")
+    parser.add_option("--profile", metavar="FILENAME",
+                      help="Count rays, intersection tests and hits, time each stage, and save it all as JSON.")
+    parser.add_option("--trace-events", metavar="FILENAME",
+                      help="Save a timeline of the render that chrome://tracing, Perfetto or speedscope can open.")
 
     cam_opts = OptionGroup(parser, "Camera Options")
     cam_opts.add_option("-r", "--resolution", type="int", nargs=2,
@@ -27,9 +46,19 @@ def main():
     cam_opts.add_option("--fov", type="float", default=95.0,
                         help="The horizontal field of view of the capture.")
     cam_opts.add_option("-s", "--samples", type="int", default=10,
-                        help="How many samples are averaged for a single pixel.")
+                        help="How many samples are averaged for a single pixel. With --adaptive, the most a pixel can take.")
+    cam_opts.add_option("-a", "--adaptive", type="float", metavar="THRESHOLD",
+                        help="Stop sampling a pixel once the standard error of its brightness falls below this.")
+    cam_opts.add_option("--min-samples", type="int", default=4,
+                        help="With --adaptive, the fewest samples a pixel can take. Default: 4.")
+    cam_opts.add_option("--sampler", choices=sorted(Sampler.SAMPLERS), default="random",
+                        help="How samples are spread over each pixel and each bounce: {}. Default: random.".format(", ".join(sorted(Sampler.SAMPLERS))))
     cam_opts.add_option("-d", "--depth", type="int", default=5,
                         help="How many times a sample ray can bounce or refract.")
+    cam_opts.add_option("--roulette", type="int", metavar="BOUNCES",
+                        help="After this many bounces, let each path carry on only with a chance equal to its brightest color, brightening the ones that do. Dim paths stop early without darkening the image, so --depth can go higher. Default: off.")
+    cam_opts.add_option("--cutoff", type="float", metavar="THROUGHPUT",
+                        help="End any path whose brightest color has fallen below this. Cheaper still, but darkens the image slightly. Default: off.")
     cam_opts.add_option("-f", "--frustum", type="float", nargs=2,
                         metavar="NEAR FAR", default=(0.1,1000),
                         help="Clipping distances of the camera viewport.")
@@ -37,35 +66,162 @@ def main():
     parser.add_option_group(cam_opts)
 
     scn_opts = OptionGroup(parser, "Scene Options")
+    scn_opts.add_option("--scene", metavar="FILENAME",
+                        help="Draws the scene described in this JSON or TOML file. Compiled scenes are kept in __pycache__ next to it.")
     scn_opts.add_option("-p", "--prepared", action="store_true", default=False,
                         help="If set, draws the scene that is defined in 'Scene.py'.")
     scn_opts.add_option("-S", "--seed", type="int",
-                        help="If generating a scene, defines the seed of the randomly generated scene. If none is provided, current date is used.")
+                        help="Seeds the randomly generated scene, if generating one, and the random numbers of every sample. If none is provided, current date is used.")
     scn_opts.add_option("-n", "--num-spheres", type="int", default=3,
                         help="If generating a scene, use this option to specify how many spheres to generate.")
 
     parser.add_option_group(scn_opts)
 
-    # Populate the options values
-    params, args = parser.parse_args()
+    prg_opts = OptionGroup(parser, "Progressive Options")
+    prg_opts.add_option("-P", "--progressive", type="int", metavar="SAMPLES",
+                        help="Render the whole frame in passes of this many samples per pixel, saving a preview and a checkpoint along the way.")
+    prg_opts.add_option("--checkpoint-every", type="int", metavar="PASSES", default=0,
+                        help="Save a checkpoint after this many passes. Default: only by time.")
+    prg_opts.add_option("--checkpoint-interval", type="float", metavar="SECONDS", default=60.0,
+                        help="Save a checkpoint once this much time has passed since the last. Default: 60.")
+    prg_opts.add_option("--resume", metavar="CHECKPOINT",
+                        help="Continue a progressive render from a checkpoint, adding samples up to --samples.")
+
+    parser.add_option_group(prg_opts)
+
+    cch_opts = OptionGroup(parser, "Cache Options")
+    cch_opts.add_option("--cache", metavar="DIRECTORY",
+                        help="Keep finished tiles here, and reuse them when the same scene is rendered again, only tracing any extra samples.")
+    cch_opts.add_option("--cache-budget", type="float", metavar="MEGABYTES", default=1024,
+                        help="Delete the least recently used tiles once the cache grows past this. Default: 1024.")
+
+    parser.add_option_group(cch_opts)
+
+    anm_opts = OptionGroup(parser, "Animation Options")
+    anm_opts.add_option("--animate", metavar="FILENAME",
+                        help="Render a numbered sequence of frames, moving the camera through the keyframes in this JSON file. Frames are saved as 'OUTPUT 0000.png' and on.")
+
+    parser.add_option_group(anm_opts)
+
+    dst_opts = OptionGroup(parser, "Distributed Options")
+    dst_opts.add_option("--coordinator", metavar="[HOST:]PORT",
+                        help="Hand out tiles to workers connecting on this address, instead of rendering here.")
+    dst_opts.add_option("--worker", metavar="[HOST:]PORT",
+                        help="Render tiles for the coordinator at this address, then exit. Scene options come from the coordinator.")
+    dst_opts.add_option("--authkey", default="PythonRayTracer",
+                        help="Shared secret that the coordinator and its workers must agree on.")
+
+    parser.add_option_group(dst_opts)
+
+    srv_opts = OptionGroup(parser, "Service Options")
+    srv_opts.add_option("--serve", metavar="[HOST:]PORT|SOCKET",
+                        help="Stay running as a render service, taking jobs with these same options over HTTP on this port, or on a Unix socket at this path.")
+    srv_opts.add_option("--keep-warm", type="int", metavar="POOLS", default=2,
+                        help="With --serve, how many scenes keep a pool of worker processes ready between jobs. Default: 2.")
+
+    parser.add_option_group(srv_opts)
+
+    return parser
+
+def check(parser, params, args):
+    # Complains through the parser about anything that can't be rendered as asked
 
     # Make sure there were no extra arguments
     if len(args) != 0:
         parser.error("Too many arguments")
 
+    if params.adaptive and params.packet:
+        parser.error("--adaptive is not supported by the packet engine")
+
+    if params.cache and (params.progressive or params.resume):
+        parser.error("--cache can't be used with progressive renders, which keep their own checkpoint")
+
+    if params.animate and (params.progressive or params.resume or params.mapped):
+        parser.error("--animate can't be used with progressive, resumed or mapped renders")
+
+    if params.scene and params.prepared:
+        parser.error("--scene and --prepared can't be used together")
+
+def main():
+    parser = options(OptionParser(version="1.0"))
+
+    # Populate the options values
+    params, args = parser.parse_args()
+    check(parser, params, args)
+
+    if params.serve:
+        parser.destroy()
+        Service.serve(params.serve, options, check, params.keep_warm, params.verbose)
+        return
+
+    if params.worker:
+        try:
+            address = Distributed.parse_address(params.worker)
+        except ValueError:
+            parser.error("Invalid worker address '{}'".format(params.worker))
+        parser.destroy()
+        Distributed.work(address, params.authkey.encode(), params.verbose)
+        return
+
+    if params.coordinator:
+        try:
+            setattr(params,"coordinator",Distributed.parse_address(params.coordinator))
+        except ValueError:
+            parser.error("Invalid coordinator address '{}'".format(params.coordinator))
+
+    setattr(params,"accumulation",None)
+    if params.resume:
+        try:
+            settings, accumulation = Progressive.load(params.resume)
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            parser.error("Unable to resume from '{}'".format(params.resume))
+
+        # The checkpoint decides what the scene is, but let a new pass size through
+        if params.progressive:
+            settings["progressive"] = params.progressive
+        for name, value in settings.items():
+            setattr(params,name,value)
+        setattr(params,"accumulation",accumulation)
+
+    if params.scene:
+        # Catch any mistakes in the scene now, while they can still be reported nicely
+        try:
+            SceneFile.load(params.scene, params.verbose)
+        except (OSError, ValueError) as error:
+            parser.error("Unable to load scene '{}': {}".format(params.scene, error))
+
     if params.output is None:
         # Make a default name if one was not provided
         setattr(params,"output",datetime.now().strftime("%Y-%m-%d %H.%M.%S.png"))
+    if params.seed is None:
+        # Same for the seed, so a day's worth of renders all share the same random scene
+        setattr(params,"seed",int(datetime.now().strftime("%Y%m%d")))
     path = os.path.join(os.getcwd(), params.output)
+
+    # Any extra images are saved alongside the output, named after what they show
+    extras = []
     if params.heatmap:
-        name = params.output[:-4] + " heatmap.png"
-        heat_path = os.path.join(os.getcwd(), name)
+        extras.append("heatmap")
+    if params.sample_map:
+        extras.append("samples")
+    setattr(params,"extras",extras)
+
+    if params.animate:
+        # Every frame gets its own numbered files, which are opened as they're saved
+        try:
+            Animation.load(params.animate)
+        except (OSError, ValueError) as error:
+            parser.error("Unable to load camera path '{}': {}".format(params.animate, error))
+        parser.destroy()
+        Scene.build_and_draw(params)
+        return
 
     try:
-        # Attempt to open the file
+        # Attempt to open the files
         file = open(path, 'wb')
-        if params.heatmap:
-            heat_file = open(heat_path, 'wb')
+        extra_files = {}
+        for name in extras:
+            extra_files[name] = open(os.path.join(os.getcwd(), "{} {}.png".format(params.output[:-4], name)), 'wb')
     except FileNotFoundError:
         parser.error("Unable to open file {}".format(params.output))
     except IsADirectoryError:
@@ -74,22 +230,26 @@ def main():
     if params.debug:
         print("File '{}' opened.".format(params.output))
 
+    # PNG, PPM and PFM get written a strip at a time as the image comes in
+    extension = os.path.splitext(params.output)[1]
+    setattr(params,"writer",Writer.create(file, extension, *params.resolution))
+
     # The parser has served its purpose
     parser.destroy()
 
     # Drawing the image
-    output, heatmap = Scene.build_and_draw(params)
+    output, images = Scene.build_and_draw(params)
 
-    # Save the image as a png
-    #TODO: Handle other file formats
-    output.save(file, "PNG")
+    # Anything that wasn't written as it came in gets saved all at once
+    if output is not None:
+        Color.save(output, file, extension)
 
-    if heatmap:
-        heatmap.save(heat_file, "PNG")
+    for name, image in images.items():
+        image.save(extra_files[name], "PNG")
 
     file.close()
-    if params.heatmap:
-        heat_file.close()
+    for extra_file in extra_files.values():
+        extra_file.close()
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,6 @@
-from PIL import Image
+from PIL import Image, ImageChops
 from collections import namedtuple
+from array import array
 
 class Color(namedtuple('Color', 'r g b')):
     """A class that holds RGB values with floating point precision"""
@@ -7,9 +8,13 @@ class Color(namedtuple('Color', 'r g b')):
     def apply_transform(self, func):
         return Color._make(map(func, self))
 
+    def luminance(self):
+        # Perceived brightness, weighted by how sensitive our eyes are to each channel
+        return 0.2126 * self.r + 0.7152 * self.g + 0.0722 * self.b
+
     def quantize(self):
         # Convert from floating point to 8-bit values for each color channel
-        return self.apply_transform(lambda x: min(max(int(255*x),0),255))
+        return self.apply_transform(quantize)
 
     def __add__(self, rhs):
         return Color(self.r+rhs.r, self.g+rhs.g, self.b+rhs.b) if isinstance(rhs, Color) else NotImplemented
@@ -60,44 +65,50 @@ def heat_gradient(value):
     cyan = min(max(int(255 * (1 - value)**(curve)), 0), 255)
     return (red,cyan,cyan)
 
-def normalize(data):
-    lo = hi = data[0][0]
-
-    for row in data:
-        for element in row:
-            if element > hi:
-                hi = element
-            elif element < lo:
-                lo = element
-
-    span = hi - lo
-    return [[(e - lo)/span for e in row] for row in data]
+def quantize(value):
+    # Convert a single channel from floating point to 8-bit
+    return min(max(int(255*value),0),255)
 
 #MARK: PIL implementation
 
-def heatmap_from_data(data, dimensions):
-    # Start with a black image
-    image = Image.new('RGB', dimensions, (0,0,0))
-
-    data = normalize(data)
-
-    for y in range(dimensions[1]):
-        for x in range(dimensions[0]):
-            image.putpixel((x, y), heat_gradient(data[y][x]))
-
-    return image
-
-def image_from_pixels(pixels, dimensions):
-    # Start with a black image
-    image = Image.new('RGB', dimensions, (0,0,0))
+def float_image(values, dimensions):
+    # A single channel 32-bit float image, from one value per pixel, row after row
+    return Image.frombytes('F', dimensions, array('f', values).tobytes())
 
+def heatmap_from_data(data, dimensions):
+    # Spread the data over the 256 levels of a grayscale image
+    lo, hi = min(data), max(data)
+    scale = 255.0 / ((hi - lo) or 1.0)
+    levels = float_image(data, dimensions).point(lambda v: v * scale - lo * scale).convert('L')
+
+    # Then look up the color of each level
+    table = [heat_gradient(level / 255.0) for level in range(256)]
+    return Image.merge('RGB', [levels.point([color[channel] for color in table]) for channel in range(3)])
+
+def sub_filter(image):
+    # PNG's Sub filter: every byte minus the same channel of the pixel to its left, wrapping around at 256
+    shifted = Image.new(image.mode, image.size)
+    if image.width > 1:
+        shifted.paste(image.crop((0, 0, image.width - 1, image.height)), (1, 0))
+    return ImageChops.subtract_modulo(image, shifted)
+
+def save(image, file, extension):
+    # Saves in whichever format PIL knows the extension as, or PNG if it doesn't know it
+    image.save(file, Image.registered_extensions().get(extension.lower(), "PNG"))
+
+def blank_image(dimensions):
+    # An all black image, for filling in a piece at a time
+    return Image.new('RGB', dimensions)
+
+def image_from_pixels(channels, dimensions):
+    # Channels are the r, g and b planes of the image, each row after row.
     # Quantize will convert a pixel from floating point to 8bit
     # colorspace. I do this by clipping any value greater than the
-    # max. Another way to do this is to normalize all values with
-    # the largest all at once after calculating all the pixels.
-    for y in range(dimensions[1]):
-        for x in range(dimensions[0]):
-            image.putpixel((x, y), pixels[y][x].quantize())
+    # max, which PIL does for us when converting to 8 bits, dropping
+    # the fraction just like int(255*x) does for one pixel. Another
+    # way to do this is to normalize all values with the largest
+    # all at once after calculating all the pixels.
+    image = Image.merge('RGB', [float_image(channel, dimensions).point(lambda v: v * 255).convert('L') for channel in channels])
 
     # This would be a good place to do any post-processing on the image
     # For reference, PIL in python 3 uses the Pillow library
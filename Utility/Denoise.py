@@ -0,0 +1,119 @@
+##############
+# Denoise.py #
+##############
+# Filters the noise out of a render with few samples,
+# using an edge-avoiding à-trous wavelet filter. Each
+# pass blurs with a small 5x5 kernel whose taps are
+# spread twice as far apart as the last pass's, so five
+# passes reach 62 pixels across for the price of 125
+# taps a pixel.
+#
+# Blurring alone would smear every edge, so each tap
+# is weighed by how alike the two pixels are in their
+# guides: what the camera saw first through each pixel,
+# its color (albedo), normal and distance. Those come
+# out nearly clean after a handful of samples, unlike
+# the lighting, so a tap across the silhouette of a
+# sphere or onto a different material counts for next
+# to nothing. Taps whose brightness is much further
+# apart than the noise can explain are turned down too,
+# which keeps shadows and reflections from bleeding.
+#
+# The lighting is filtered on its own, with the albedo
+# divided out, and multiplied back in at the end, so
+# the colors of materials stay as sharp as they were.
+
+import numpy as np
+
+# The B3 spline each pass smooths with
+KERNEL = (1.0 / 16, 4.0 / 16, 6.0 / 16, 4.0 / 16, 1.0 / 16)
+PASSES = 5
+
+# How far apart two pixels' guides can be before a tap between them stops counting
+COLOR = 0.75    # differences in brightness, in standard deviations of the noise
+NORMAL = 16.0   # the power the cosine between normals is raised to
+DEPTH = 4.0     # differences in distance, compared to how fast the distance is changing
+ALBEDO = 0.1    # differences in albedo
+
+# Keeps dark albedos and flat surfaces from dividing by zero, and normals at right angles from taking logs of it
+EPSILON = 1e-4
+TINY = 1e-30
+
+LUMINANCE = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+def _luminance(image):
+    return np.tensordot(LUMINANCE, image, 1)
+
+def _shifted(padded, pad, dx, dy, height, width):
+    # The window of a padded image that lines each pixel up with the one (dx, dy) away
+    return padded[..., pad + dy:pad + dy + height, pad + dx:pad + dx + width]
+
+def _pad(image, pad):
+    # Pads with copies of the border, so taps off the edge of the image land on the nearest pixel
+    return np.pad(image, ((0, 0),) * (image.ndim - 2) + ((pad, pad), (pad, pad)), mode='edge')
+
+def _blur(image):
+    # A 3x3 box blur, to take the edge off the noise
+    padded = _pad(image, 1)
+    height, width = image.shape[-2:]
+    return sum(_shifted(padded, 1, dx, dy, height, width) for dy in (-1, 0, 1) for dx in (-1, 0, 1)) / 9
+
+def denoise(colors, guides, width, height):
+    # Takes the r, g and b planes of the image and the planes of its guides, each row after row,
+    # and gives back the r, g and b planes of the filtered image
+    color = np.array(colors, dtype=np.float32).reshape(3, height, width)
+    guides = np.array(guides, dtype=np.float32).reshape(-1, height, width)
+    albedo, normal, depth = guides[0:3], guides[3:6], guides[6]
+
+    # Normals averaged over a pixel come up short of unit length. Pixels that saw the sky have
+    # no normal, so give them one of their own in a fourth dimension, which only they point along
+    length = np.sqrt((normal ** 2).sum(axis=0))
+    normal = np.concatenate((normal / np.where(length > 0, length, 1.0), (length == 0)[None]))
+
+    # Filter the lighting rather than the color, so textures and material edges don't blur
+    albedo = np.maximum(albedo, EPSILON)
+    lighting = color / albedo
+
+    # The noise in each pixel's brightness, judged by how much it differs from its neighbours
+    brightness = _luminance(lighting)
+    variance = np.maximum(_blur(brightness ** 2) - _blur(brightness) ** 2, 0.0)
+
+    # How fast the distance changes from one pixel to the next, to tell edges from slopes
+    slope_y, slope_x = np.gradient(depth)
+    flat = EPSILON * depth + EPSILON
+
+    for iteration in range(PASSES):
+        step = 2 ** iteration
+        pad = 2 * step
+        # Brightness is compared after a little blur, or every speck of noise would look like an edge
+        brightness = _luminance(_blur(lighting))
+        deviation = 1.0 / (COLOR * np.sqrt(_blur(variance)) + EPSILON)
+
+        padded = [_pad(image, pad) for image in (lighting, variance, brightness, albedo, normal, depth)]
+        total = np.zeros_like(lighting)
+        total_variance = np.zeros_like(variance)
+        weights = np.zeros_like(variance)
+
+        for j, ky in enumerate(KERNEL):
+            for i, kx in enumerate(KERNEL):
+                dx, dy = (i - 2) * step, (j - 2) * step
+                tap_lighting, tap_variance, tap_brightness, tap_albedo, tap_normal, tap_depth = (
+                    _shifted(image, pad, dx, dy, height, width) for image in padded)
+
+                # All the guides together, as the power of e the tap is weighed by
+                cosine = np.maximum((normal * tap_normal).sum(axis=0), TINY)
+                power = (NORMAL * np.log(cosine)
+                         - np.abs(depth - tap_depth) / (DEPTH * np.abs(slope_x * dx + slope_y * dy) + flat)
+                         - ((albedo - tap_albedo) ** 2).sum(axis=0) * (1.0 / ALBEDO ** 2)
+                         - np.abs(brightness - tap_brightness) * deviation)
+                weight = np.exp(power) * (kx * ky)
+
+                total += tap_lighting * weight
+                total_variance += tap_variance * weight ** 2
+                weights += weight
+
+        # The center tap always counts, so the weights never add up to nothing
+        lighting = total / weights
+        variance = total_variance / weights ** 2
+
+    return (lighting * albedo).reshape(3, -1).tolist()
@@ -0,0 +1,244 @@
+from array import array
+from operator import mul
+import mmap
+import os
+import pickle
+import struct
+import Utility.Color as Color
+
+# How many planes of doubles there are: r, g and b sums, sample counts, and times
+PLANES = 5
+
+# A framebuffer for denoising has a plane more for each guide, summed like the colors: the color,
+# normal and distance of the first thing each sample hit, or the sky's color and the far distance
+GUIDES = ('albedo r', 'albedo g', 'albedo b', 'normal x', 'normal y', 'normal z', 'depth')
+
+# A framebuffer kept in a file starts with a header of its dimensions, how many
+# passes it's had and any settings saved with it, and then the planes, a page in
+MAGIC = b"RTFRAME1"
+HEADER = struct.Struct('<8sIIQI')
+HEADER_SIZE = 4096
+
+# How many rows are developed at a time
+STRIP = 64
+
+class Framebuffer(object):
+    """Running per-pixel totals of color, samples and time, in one flat block of doubles.
+    The block can live in shared memory or in a file mapped into memory, so that worker
+    processes can write into it directly."""
+
+    def __init__(self, width, height, shared=False, name=None, path=None, existing=False, guides=False):
+        self.width = width
+        self.height = height
+        self.passes = 0
+        self.path = path
+        self.planes = PLANES + (len(GUIDES) if guides else 0)
+        self._memory = self._map = None
+
+        size = width * height * self.planes * 8
+        if path:
+            # The totals live in a file and only the pages in use need to be in memory,
+            # so they never have to fit in RAM. A new file starts out as all zeros
+            self._file = open(path, 'r+b' if existing else 'w+b')
+            if not existing:
+                self._file.truncate(HEADER_SIZE + size)
+            self._map = mmap.mmap(self._file.fileno(), HEADER_SIZE + size)
+            self._buffer = memoryview(self._map)[HEADER_SIZE:]
+        elif name:
+            # Attach to a framebuffer that another process made
+            from multiprocessing.shared_memory import SharedMemory
+            self._memory = SharedMemory(name)
+            self._buffer = self._memory.buf
+        elif shared:
+            from multiprocessing.shared_memory import SharedMemory
+            self._memory = SharedMemory(create=True, size=size)
+            self._buffer = self._memory.buf
+        else:
+            self._buffer = bytearray(size)
+
+        self._values = memoryview(self._buffer)[:size].cast('d')
+        if path and not existing:
+            self.flush()
+        if shared and not name:
+            # Freshly made shared memory isn't guaranteed to be zeroed everywhere
+            self.clear()
+
+        # Each quantity gets its own plane of the block, laid out row by row
+        pixels = width * height
+        planes = [self._values[plane * pixels:(plane + 1) * pixels] for plane in range(self.planes)]
+        self.reds, self.greens, self.blues, self.samples, self.times = planes[:PLANES]
+        self.guides = tuple(planes[PLANES:])
+
+    @classmethod
+    def open(cls, path):
+        # Attach to a framebuffer kept in a file, whether another process is using it or it was saved earlier
+        with open(path, 'rb') as file:
+            magic, width, height, passes, length = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("'{}' is not a framebuffer".format(path))
+
+        # Only a framebuffer with guides has room for more than the usual planes
+        guides = os.path.getsize(path) - HEADER_SIZE > width * height * PLANES * 8
+        framebuffer = cls(width, height, path=path, existing=True, guides=guides)
+        framebuffer.passes = passes
+        return framebuffer
+
+    @property
+    def name(self):
+        return self._memory.name if self._memory else None
+
+    def settings(self):
+        # Whatever settings were last flushed with a framebuffer kept in a file
+        magic, width, height, passes, length = HEADER.unpack_from(self._map)
+        return pickle.loads(self._map[HEADER.size:HEADER.size + length]) if length else {}
+
+    def flush(self, settings=None):
+        # Writes a framebuffer kept in a file out to disk, so it can be picked back up later
+        blob = pickle.dumps(settings, pickle.HIGHEST_PROTOCOL) if settings is not None else b""
+        if HEADER.size + len(blob) > HEADER_SIZE:
+            raise ValueError("Settings are too big to save with the framebuffer")
+        HEADER.pack_into(self._map, 0, MAGIC, self.width, self.height, self.passes, len(blob))
+        self._map[HEADER.size:HEADER.size + len(blob)] = blob
+        self._map.flush()
+
+    def clear(self):
+        # Back to no samples at all, so the framebuffer can take another render
+        self._values[:] = memoryview(bytes(len(self._values) * 8)).cast('d')
+        self.passes = 0
+
+    def share(self):
+        # A copy of this framebuffer in shared memory
+        shared = Framebuffer(self.width, self.height, shared=True, guides=bool(self.guides))
+        shared._values[:] = self._values
+        shared.passes = self.passes
+        return shared
+
+    def close(self, unlink=True):
+        # Files are left behind, they hold the totals for later; shared memory is unlinked unless asked not to
+        for view in (self.reds, self.greens, self.blues, self.samples, self.times) + self.guides + (self._values,):
+            view.release()
+        if self._map:
+            self._buffer.release()
+            self._map.close()
+            self._file.close()
+        if self._memory:
+            self._memory.close()
+            if unlink:
+                self._memory.unlink()
+
+    def __getstate__(self):
+        return self.width, self.height, self.passes, self._values.tobytes()
+
+    def __setstate__(self, state):
+        width, height, passes, values = state
+        self.__init__(width, height, guides=len(values) > width * height * PLANES * 8)
+        self.passes = passes
+        self._values[:] = memoryview(values).cast('d')
+
+    def add(self, result):
+        # Adds a finished tile to the totals; its pixels are averages, so weigh them back up
+        tile = result.tile
+        for row in range(tile.height):
+            index = (tile.y + row) * self.width + tile.x
+            for pixel, count, time in zip(result.pixels[row], result.samples[row], result.times[row]):
+                self.reds[index] += pixel.r * count
+                self.greens[index] += pixel.g * count
+                self.blues[index] += pixel.b * count
+                self.samples[index] += count
+                self.times[index] += time
+                index += 1
+
+        # Guides are averages too, and only kept if there's room for them
+        if self.guides and result.guides is not None:
+            for row in range(tile.height):
+                index = (tile.y + row) * self.width + tile.x
+                for values, count in zip(result.guides[row], result.samples[row]):
+                    for plane, value in zip(self.guides, values):
+                        plane[index] += value * count
+                    index += 1
+
+    def _rows(self, tile):
+        # Where each row of a tile starts, in every plane
+        for plane in (self.reds, self.greens, self.blues, self.samples, self.times) + self.guides:
+            for row in range(tile.y, tile.y + tile.height):
+                start = row * self.width + tile.x
+                yield plane, start, start + tile.width
+
+    def read(self, tile):
+        # Everything held for a tile, plane after plane, row after row
+        values = array('d')
+        for plane, start, end in self._rows(tile):
+            values.extend(plane[start:end])
+        return values
+
+    def write(self, tile, values):
+        # Replaces everything held for a tile with values laid out like read() gives them
+        values = memoryview(values).cast('B').cast('d')
+        offset = 0
+        for plane, start, end in self._rows(tile):
+            plane[start:end] = values[offset:offset + tile.width]
+            offset += tile.width
+
+    def fewest(self, tile=None):
+        # The fewest samples any pixel has, in the whole frame or just a tile
+        if tile is None:
+            return min(self.samples)
+        starts = (row * self.width + tile.x for row in range(tile.y, tile.y + tile.height))
+        return min(min(self.samples[start:start + tile.width]) for start in starts)
+
+    def averages(self, first=0, rows=None, planes=None):
+        # The mean color of every pixel in a run of rows, as r, g and b planes, or the mean of other planes
+        rows = self.height - first if rows is None else rows
+        start, end = first * self.width, (first + rows) * self.width
+        divisors = [1.0 / count if count else 0.0 for count in self.samples[start:end]]
+        planes = (self.reds, self.greens, self.blues) if planes is None else planes
+        return [list(map(mul, plane[start:end], divisors)) for plane in planes]
+
+    def denoised(self):
+        # A copy with the noise filtered out of the colors, going by the guides to keep edges sharp.
+        # NumPy is only needed for denoising, so only import it if asked
+        import Utility.Denoise as Denoise
+        filtered = Framebuffer(self.width, self.height)
+        filtered.passes = self.passes
+        filtered.samples[:] = self.samples
+        filtered.times[:] = self.times
+
+        colors = Denoise.denoise(self.averages(), self.averages(planes=self.guides), self.width, self.height)
+        for plane, averages in zip((filtered.reds, filtered.greens, filtered.blues), colors):
+            plane[:] = array('d', map(mul, averages, self.samples))
+        return filtered
+
+    def strips(self, rows=STRIP):
+        # The image a few rows at a time, as (first row, strip image) pairs, so that
+        # developing never needs more than a strip's worth of floats at once
+        for first in range(0, self.height, rows):
+            count = min(rows, self.height - first)
+            yield first, Color.image_from_pixels(self.averages(first, count), (self.width, count))
+
+    def develop(self, extras=()):
+        # Convert our buffer from what is essentially a bitmap to an image, denoised if there are guides
+        if self.guides:
+            denoised = self.denoised()
+            try:
+                return denoised.develop(extras)
+            finally:
+                denoised.close()
+
+        dimensions = (self.width, self.height)
+        image = Color.blank_image(dimensions)
+        for first, strip in self.strips():
+            image.paste(strip, (0, first))
+        return image, self.extras(extras)
+
+    def extras(self, extras):
+        # Images of the named extras, by name
+        dimensions = (self.width, self.height)
+        images = {}
+
+        if "heatmap" in extras:
+            images["heatmap"] = Color.heatmap_from_data(self.times, dimensions)
+
+        if "samples" in extras:
+            images["samples"] = Color.heatmap_from_data(self.samples, dimensions)
+
+        return images
@@ -0,0 +1,68 @@
+##############
+# Streams.py #
+##############
+# Counter-based random numbers. Rather than drawing
+# from one shared generator, whose numbers depend on
+# everything that drew before, every sample of every
+# pixel gets its own stream, keyed by (seed, x, y,
+# sample). A number in a stream is just a hash of the
+# key and its position in the stream, so it comes out
+# the same no matter which process renders the pixel,
+# or in what order.
+#
+# The hash is SplitMix64, which is cheap enough to run
+# on plain Python ints, and on whole arrays in NumPy.
+# Each hash is split into two 32 bit halves, giving a
+# pair of numbers, which is as many as a bounce needs.
+
+MASK = 0xFFFFFFFFFFFFFFFF
+HALF = 0xFFFFFFFF
+GAMMA = 0x9E3779B97F4A7C15
+MIX1 = 0xBF58476D1CE4E5B9
+MIX2 = 0x94D049BB133111EB
+
+# Turns 32 bits of a hash into a float in [0, 1)
+SCALE = 2.0 ** -32
+
+# Keys are flipped by this before hashing for decisions, so decisions
+# come from a different hash than the stream's pairs
+DECISIONS = 0x5851F42D4C957F2D
+
+def _mix(z):
+    z = ((z ^ (z >> 30)) * MIX1) & MASK
+    z = ((z ^ (z >> 27)) * MIX2) & MASK
+    return z ^ (z >> 31)
+
+def pixel(seed, x, y):
+    # The key that all of a pixel's streams start from; each part is mixed in
+    # turn, so neighbouring pixels are unrelated
+    return _mix(_mix(_mix(seed & MASK) ^ x) ^ y)
+
+def stream(pixel, sample):
+    # The key of one sample's stream
+    return _mix(pixel ^ sample)
+
+def hash(key, bounce):
+    # The whole 64 bit hash behind a stream's pair of numbers for a bounce
+    return _mix((key + (bounce + 1) * GAMMA) & MASK)
+
+def uniforms(keys, bounce):
+    # A pair of numbers in [0, 1) from each stream, for the given bounce. The
+    # camera takes bounce 0 to place the sample, and the nth bounce off a
+    # surface takes bounce n
+    offset = (bounce + 1) * GAMMA
+    draws = []
+    for key in keys:
+        z = (key + offset) & MASK
+        z = ((z ^ (z >> 30)) * MIX1) & MASK
+        z = ((z ^ (z >> 27)) * MIX2) & MASK
+        z ^= z >> 31
+        draws.append(((z >> 32) * SCALE, (z & HALF) * SCALE))
+    return draws
+
+def decisions(keys, bounce):
+    # A number in [0, 1) from each stream for deciding things at the given bounce, like
+    # whether a path carries on. These have nothing to do with the stream's pairs, so
+    # whatever the sampler does with those, decisions stay independent of them
+    offset = (bounce + 1) * GAMMA
+    return [(_mix(((key ^ DECISIONS) + offset) & MASK) >> 32) * SCALE for key in keys]
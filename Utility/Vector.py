@@ -1,56 +1,67 @@
 from collections import namedtuple
-from operator import mul
-from random import gauss
-from math import sqrt
+from math import sqrt, pi, cos, sin
 
 class Vector(namedtuple('Point', 'x y z')):
     """A math vector capable of indication direction and magnitude"""
 
+    __slots__ = ()
+
     def unit(self):
         # Normalization
-        return self/abs(self)
+        x, y, z = self
+        length = (x * x + y * y + z * z) ** 0.5
+        return _new(Vector, (x / length, y / length, z / length))
 
-    # These could be more pythonic, but I'm worried about speed and simplicity more
+    # These could be more pythonic, but I'm worried about speed and simplicity more.
+    # Building through _new skips namedtuple's own constructor, which adds up
     def __add__(self, rhs):
         if isinstance(rhs, Vector):
-            return Vector(self.x + rhs.x, self.y + rhs.y, self.z + rhs.z)
+            return _new(Vector, (self[0] + rhs[0], self[1] + rhs[1], self[2] + rhs[2]))
         return NotImplemented
 
     def __sub__(self, rhs):
         if isinstance(rhs, Vector):
-            return Vector(self.x - rhs.x, self.y - rhs.y, self.z - rhs.z)
+            return _new(Vector, (self[0] - rhs[0], self[1] - rhs[1], self[2] - rhs[2]))
         return NotImplemented
 
     def __neg__(self):
-        return Vector(-self.x, -self.y, -self.z)
+        return _new(Vector, (-self[0], -self[1], -self[2]))
 
     def __abs__(self):
-        return sum(x**2 for x in self) ** 0.5
+        x, y, z = self
+        return (x * x + y * y + z * z) ** 0.5
 
     def __truediv__(self, rhs):
         if isinstance(rhs, (int, float)):
-            return Vector(self.x/rhs, self.y/rhs, self.z/rhs)
+            return _new(Vector, (self[0] / rhs, self[1] / rhs, self[2] / rhs))
         return NotImplemented
 
     def __mul__(self, rhs):
         if isinstance(rhs, Vector):
             # Elementwise product
-            return Vector(self.x * rhs.x, self.y * rhs.y, self.z * rhs.z)
+            return _new(Vector, (self[0] * rhs[0], self[1] * rhs[1], self[2] * rhs[2]))
         elif isinstance(rhs, (int, float)):
             # Scaling
-            return Vector(self.x*rhs, self.y*rhs, self.z*rhs)
+            return _new(Vector, (self[0] * rhs, self[1] * rhs, self[2] * rhs))
         return NotImplemented
 
     def __str__(self):
         return "<{:2f}, {:2f}, {:2f}>".format(self.x, self.y, self.z)
 
-def rand_unit_vector():
-    return Vector._make([gauss(0, 1) for i in range(3)]).unit()
+# Builds a Vector straight from a tuple of its parts
+_new = tuple.__new__
+
+def rand_unit_vector(u, v):
+    # A uniformly random direction, from two uniformly random numbers in [0, 1)
+    z = 2 * u - 1
+    r = (1 - z * z) ** 0.5
+    phi = 2 * pi * v
+    return _new(Vector, (r * cos(phi), r * sin(phi), z))
 
 def dot(lhs, rhs):
     # Dot-product
     if isinstance(lhs, Vector) and isinstance(rhs, Vector):
-        return sum(map(mul, lhs, rhs))
+        return lhs[0] * rhs[0] + lhs[1] * rhs[1] + lhs[2] * rhs[2]
     return NotImplemented
 
 def cross(lhs, rhs):
@@ -61,26 +72,54 @@ def cross(lhs, rhs):
 
 def reflect(direction, normal):
     # Reflect a vector across a surface, assumes dir and normal are unit vectors
-    return (direction - normal * (2 * dot(direction, normal))).unit()
+    dx, dy, dz = direction
+    nx, ny, nz = normal
+    scale = 2 * (dx * nx + dy * ny + dz * nz)
+    return unit(dx - nx * scale, dy - ny * scale, dz - nz * scale)
 
 def refract(direction, normal, eta):
     # Refract a vector on surface with normal and eta of refraction index ratio
-    dt = dot(direction, normal)
+    dx, dy, dz = direction
+    nx, ny, nz = normal
+    dt = dx * nx + dy * ny + dz * nz
     discriminant = 1.0 - ((eta ** 2) * (1.0 - (dt ** 2)))
-    return (direction - (normal * dt)) * eta - (normal * sqrt(discriminant)) if discriminant > 0 else None
-
+    if discriminant <= 0:
+        return None
+    root = sqrt(discriminant)
+    return _new(Vector, ((dx - nx * dt) * eta - nx * root,
+                         (dy - ny * dt) * eta - ny * root,
+                         (dz - nz * dt) * eta - nz * root))
+
+#MARK: unpacked math
+# The hot path of the tracer works on plain floats wherever it can,
+# and only packs them into a Vector once it has a result to keep
+
+def unit(x, y, z):
+    # Normalization, straight from the parts
+    length = (x * x + y * y + z * z) ** 0.5
+    return _new(Vector, (x / length, y / length, z / length))
 
 #MARK: rays
 
 class Ray(object):
     """A class that holds all our rays with which we trace"""
-    def __init__(self, origin, direction):
-        self.origin = Vector._make(origin)
-        self.direction = Vector._make(direction).unit()
+
+    __slots__ = ('origin', 'direction')
+
+    def __init__(self, origin, direction, normalized=False):
+        # Pass normalized if the direction is already a unit Vector, to skip doing it again
+        self.origin = origin if type(origin) is Vector else Vector._make(origin)
+        if normalized:
+            self.direction = direction
+        else:
+            x, y, z = direction
+            self.direction = unit(x, y, z)
 
     def traverse(self, distance = 0.000001):
-        return Ray(self.origin + self.direction * distance, self.direction)
+        return Ray(self.project(distance), self.direction, True)
 
     def project(self, distance):
         # Returns a point 'distance' units away from origin in direction
-        return self.origin + self.direction * distance
+        ox, oy, oz = self.origin
+        dx, dy, dz = self.direction
+        return _new(Vector, (ox + dx * distance, oy + dy * distance, oz + dz * distance))
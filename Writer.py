@@ -0,0 +1,167 @@
+#############
+# Writer.py #
+#############
+# Writes the image out a few rows at a time, as soon
+# as they're finished, rather than holding on to the
+# whole frame and saving it at the end. Anything
+# reading the file can start on the top of the image
+# while the bottom is still being traced.
+#
+# PNG and PPM are 8 bits a channel, so anything
+# brighter than white gets clipped. PFM keeps the
+# floating point colors just as they were traced.
+
+from abc import ABCMeta, abstractmethod
+from array import array
+import struct
+import sys
+import zlib
+import Utility.Color as Color
+from Utility.Framebuffer import STRIP
+
+class Writer(object):
+    """Encodes an image a run of rows at a time, from top to bottom"""
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, file, width, height):
+        self.file = file
+        self.width = width
+        self.height = height
+        # The next row to be written
+        self.row = 0
+
+    @abstractmethod
+    def write(self, channels, rows):
+        # Must encode the next rows, given as the r, g and b planes of their mean colors
+        pass
+
+    def close(self):
+        # Finishes off the file once every row is in
+        self.file.flush()
+
+class PNG(Writer):
+    """8-bit RGB PNG, compressed as a single zlib stream that's flushed after every strip"""
+
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, file, width, height):
+        super().__init__(file, width, height)
+        self._compressor = zlib.compressobj(6)
+        self.file.write(self.SIGNATURE)
+        # 8 bits per channel, truecolor, no interlacing
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data)
+        self.file.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+    def write(self, channels, rows):
+        # Every row gets the Sub filter, which turns smooth gradients into runs that compress well
+        strip = Color.sub_filter(Color.image_from_pixels(channels, (self.width, rows))).tobytes()
+        stride = self.width * 3
+        data = b"".join(b"\x01" + strip[start:start + stride] for start in range(0, len(strip), stride))
+
+        # Flushing after every strip lets a reader decode everything written so far
+        self._chunk(b"IDAT", self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.row += rows
+
+    def close(self):
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
+        super().close()
+
+class PPM(Writer):
+    """8-bit binary PPM, just a header and the raw rows"""
+
+    def __init__(self, file, width, height):
+        super().__init__(file, width, height)
+        self.file.write("P6\n{} {}\n255\n".format(width, height).encode())
+
+    def write(self, channels, rows):
+        self.file.write(Color.image_from_pixels(channels, (self.width, rows)).tobytes())
+        self.row += rows
+
+class PFM(Writer):
+    """Little-endian 32-bit float PFM, which keeps colors brighter than white"""
+
+    def __init__(self, file, width, height):
+        super().__init__(file, width, height)
+        # A negative scale means little-endian
+        header = "PF\n{} {}\n-1.0\n".format(width, height).encode()
+        self.file.write(header)
+        self._start = len(header)
+
+    def write(self, channels, rows):
+        # Interleave the planes into r, g, b triples
+        pixels = array('f', bytes(4 * 3 * self.width * rows))
+        for offset, channel in enumerate(channels):
+            pixels[offset::3] = array('f', channel)
+        if sys.byteorder == "big":
+            pixels.byteswap()
+
+        # PFM stores its rows from the bottom up, so each row goes where it belongs
+        stride = 3 * self.width
+        for row in range(rows):
+            self.file.seek(self._start + (self.height - 1 - self.row - row) * stride * 4)
+            self.file.write(pixels[row * stride:(row + 1) * stride].tobytes())
+        self.row += rows
+
+    def close(self):
+        self.file.seek(0, 2)
+        super().close()
+
+FORMATS = {
+    ".png": PNG,
+    ".ppm": PPM,
+    ".pfm": PFM,
+}
+
+def create(file, extension, width, height):
+    # A writer for the file's format, or None if it can't be written a row at a time
+    writer = FORMATS.get(extension.lower())
+    return writer(file, width, height) if writer else None
+
+class Stream(object):
+    """Hands rows of a framebuffer to a writer as soon as every tile covering them is in"""
+
+    def __init__(self, framebuffer, writer):
+        self.framebuffer = framebuffer
+        self.writer = writer
+        # How many pixels of each row are finished
+        self._done = [0] * framebuffer.height
+
+    def add(self, tile):
+        # A framebuffer with guides is denoised, which can't start before every tile is in
+        if self.framebuffer.guides:
+            return
+
+        for row in range(tile.y, tile.y + tile.height):
+            self._done[row] += tile.width
+
+        # Write out the finished rows that come next, if there are any
+        first = self.writer.row
+        last = first
+        while last < self.framebuffer.height and self._done[last] >= self.framebuffer.width:
+            last += 1
+        self._write(first, last, self.framebuffer)
+
+    def finish(self):
+        # Writes whatever is left, finished or not, and closes the file off
+        if self.framebuffer.guides:
+            denoised = self.framebuffer.denoised()
+            try:
+                self._write(self.writer.row, denoised.height, denoised)
+            finally:
+                denoised.close()
+        else:
+            self._write(self.writer.row, self.framebuffer.height, self.framebuffer)
+        self.writer.close()
+
+    def _write(self, first, last, framebuffer):
+        # A strip at a time, to keep the floats in hand down to a few rows
+        for start in range(first, last, STRIP):
+            rows = min(STRIP, last - start)
+            self.writer.write(framebuffer.averages(start, rows), rows)
+        if last > first:
+            self.writer.file.flush()